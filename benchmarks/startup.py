@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Measures the startup time of review-rot, and which libraries of the git
+services get imported, e.g.:
+
+    python benchmarks/startup.py --runs 20
+"""
+import argparse
+import os
+import subprocess
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Libraries of the git services
+LIBRARIES = ('github', 'gitlab', 'requests', 'dateutil')
+
+CASES = [
+    ('import reviewrot',
+     'import reviewrot'),
+    ('pagure service',
+     'import reviewrot; reviewrot.get_git_service("pagure")'),
+    ('all services (eager imports)',
+     'import reviewrot.githubstack, reviewrot.gitlabstack, '
+     'reviewrot.gerritstack, reviewrot.pagurestack'),
+]
+
+REPORT = ('import sys; '
+          'print(",".join(name for name in %r if name in sys.modules))'
+          % (LIBRARIES,))
+
+
+def run(args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.check_output([sys.executable] + args, env=env,
+                                       stderr=devnull).decode('utf-8')
+
+
+def measure(args, runs):
+    timer = timeit.Timer(lambda: run(args))
+    times = sorted(timer.repeat(repeat=runs, number=1))
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Number of runs of every case, the median is '
+                             'reported.')
+    args = parser.parse_args()
+
+    baseline = measure(['-c', 'pass'], args.runs)
+    print('%-32s %10s  %s' % ('case', 'ms', 'libraries imported'))
+    print('%-32s %10.1f' % ('interpreter', baseline * 1000))
+    for name, code in CASES:
+        elapsed = measure(['-c', code], args.runs)
+        libraries = run(['-c', code + '; ' + REPORT]).strip()
+        print('%-32s %10.1f  %s' % (name, elapsed * 1000, libraries or '-'))
+    elapsed = measure([os.path.join(ROOT, 'bin', 'review-rot'), '--help'],
+                      args.runs)
+    print('%-32s %10.1f' % ('review-rot --help', elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
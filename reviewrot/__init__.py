@@ -1,4 +1,5 @@
 import collections
+import importlib
 import logging
 import os
 import platform
@@ -7,36 +8,172 @@ from shutil import copyfile
 from select import select
 import sys
 
-from reviewrot.gerritstack import GerritService
-from reviewrot.githubstack import GithubService
-from reviewrot.gitlabstack import GitlabService
-from reviewrot.pagurestack import PagureService
-
 import yaml
 
 log = logging.getLogger(__name__)
 
+_mapping_tag = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
+
+
+class ConfigLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    """
+    Loads configuration files, with libyaml if it is available.
+    """
+
+
+class OrderedConfigLoader(ConfigLoader):
+    """
+    Loads configuration files in the same order as they are defined, so
+    that, while saving them in new format, order is maintained.
+    """
+
+
+class ConfigDumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    """
+    Saves configuration files, keeping the order of ordered dicts and
+    printing a blank scalar rather than null.
+    """
+
+
+def _construct_ordered_mapping(loader, node):
+    return collections.OrderedDict(loader.construct_pairs(node))
+
+
+def _represent_ordered_mapping(dumper, data):
+    return dumper.represent_mapping(_mapping_tag, data.items())
+
+
+def _represent_none(dumper, _):
+    return dumper.represent_scalar('tag:yaml.org,2002:null', u'')
+
+
+OrderedConfigLoader.add_constructor(_mapping_tag, _construct_ordered_mapping)
+ConfigDumper.add_representer(collections.OrderedDict,
+                             _represent_ordered_mapping)
+ConfigDumper.add_representer(type(None), _represent_none)
 
-def get_git_service(git):
+# Configurations loaded by this process, by path, so that watch mode
+# re-reads them every refresh without parsing them again until they change
+_configs = {}
+
+# Classes of the git services, imported on first use so that running with
+# one type of git service doesn't import the libraries of the others
+_service_classes = {
+    'github': ('reviewrot.githubstack', 'GithubService'),
+    'gitlab': ('reviewrot.gitlabstack', 'GitlabService'),
+    'pagure': ('reviewrot.pagurestack', 'PagureService'),
+    'gerrit': ('reviewrot.gerritstack', 'GerritService'),
+}
+
+# Git services shared by all the config items of the same type, host and
+# token, so that their clients are set up only once per run
+_git_services = {}
+
+
+def get_git_service(git, host=None, token=None):
     """
     Returns git service as per requested.
 
     Args:
         git (str): String indicating git service requested.
+        host (str): Host of the git service.
+        token (str): Token used to authenticate to the git service.
 
     Returns:
-        Returns desired git service
-    """
-    if git == "github":
-        return GithubService()
-    elif git == "gitlab":
-        return GitlabService()
-    elif git == "pagure":
-        return PagureService()
-    elif git == "gerrit":
-        return GerritService()
-    else:
+        Returns desired git service, shared by all the callers asking
+        for the same git service, host and token
+    """
+    key = (git, host, token)
+    if key not in _git_services:
+        _git_services[key] = get_service_class(git)()
+    return _git_services[key]
+
+
+def get_service_class(git):
+    """
+    Returns the class of a git service, importing its module if needed.
+
+    Args:
+        git (str): String indicating git service requested.
+
+    Returns:
+        Returns the class of the git service
+    """
+    if git not in _service_classes:
         raise ValueError('requested git service %s is not valid' % (git))
+    module_name, class_name = _service_classes[git]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def iter_requests(review_requests, jobs=None, isolate=False):
+    """
+    Calls request_reviews for every requested git service, optionally
+    using a bounded pool of worker threads, and hands out every response
+    as soon as it arrives.
+
+    Args:
+        review_requests (list): List of (git_service, kwargs) tuples, where
+                                kwargs are passed to request_reviews
+        jobs (int): Maximum number of requests to run concurrently.
+                    Requests are made serially if None or 1.
+        isolate (bool): If True, a failing request is logged and its
+                        exception handed out as its response, instead of
+                        stopping the other requests
+
+    Returns:
+        generator yielding (index, response) tuples, where index is the
+        position of the request, in the order the responses arrive
+    """
+    request = _request_isolated_reviews if isolate else _request_reviews
+    if not jobs or jobs <= 1 or len(review_requests) <= 1:
+        for index, review_request in enumerate(review_requests):
+            yield index, request(review_request)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    from reviewrot.basereview import get_session
+    # make sure every worker can keep its own connection open
+    get_session(pool_size=jobs)
+    pool = ThreadPool(min(jobs, len(review_requests)))
+    try:
+        for result in pool.imap_unordered(
+                lambda indexed: (indexed[0], request(indexed[1])),
+                enumerate(review_requests)):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _request_reviews(review_request):
+    """
+    Unpacks a (git_service, kwargs) tuple and requests the reviews.
+    """
+    git_service, kwargs = review_request
+    return git_service.request_reviews(**kwargs)
+
+
+def _request_isolated_reviews(review_request):
+    """
+    Requests the reviews like _request_reviews, but returns the exception
+    raised by a failing request instead.
+    """
+    try:
+        return _request_reviews(review_request)
+    except Exception as e:
+        log.exception('Failed to request reviews with %s',
+                      _describe_request(review_request[1]))
+        return e
+
+
+def _describe_request(kwargs):
+    """
+    Returns the user and repository names a request is made for, without
+    its credentials, for the logs.
+    """
+    return dict((key, kwargs.get(key))
+                for key in ('host', 'user_name', 'repo_name')
+                if kwargs.get(key) is not None)
 
 
 def get_arguments(cli_arguments, config_arguments, choices):
@@ -53,36 +190,20 @@ def get_arguments(cli_arguments, config_arguments, choices):
      """
     parsed_arguments = {}
     command_line_args = vars(cli_arguments)
-    grouped_arguments = {'state', 'duration', 'value'}
-    logged_error = False
 
     for arg in command_line_args:
         if command_line_args.get(arg) is not None:
             parsed_arguments[arg] = command_line_args.get(arg)
 
     if config_arguments is not None:
-        for argument in config_arguments:
+        valid_arguments = validate_config_arguments(config_arguments,
+                                                    choices)
+        for argument, config_value in valid_arguments.items():
             # Explicitly commandline arguments cannot be specified
             # false or none.
             if command_line_args.get(argument) is None or \
                command_line_args.get(argument) is False:
-                # if argument is present in grouped_arguments,
-                # all the associated arguments should also
-                # be specified in the config file
-                if argument not in grouped_arguments or \
-                    (argument in grouped_arguments and
-                     grouped_arguments.issubset(config_arguments.keys())):
-                    config_value = config_arguments.get(argument)
-                    if is_valid_choice(argument, config_value, choices):
-                        parsed_arguments[argument] = config_value
-                    else:
-                        log.warn("Invalid choice '%s' provided for '%s' in"
-                                 " config file" %
-                                 (config_value, argument))
-                elif not logged_error:
-                    log.warn("Either no or all arguments (state, duration "
-                             "and value) are required in config file")
-                    logged_error = True
+                parsed_arguments[argument] = config_value
 
         # --debug, --reverse and --insecure or --cacert flags are used to
         # specify arguments from command line. If not specified, value will
@@ -112,6 +233,55 @@ def get_arguments(cli_arguments, config_arguments, choices):
     return parsed_arguments
 
 
+def validate_config_arguments(config_arguments, choices):
+    """
+       Returns the arguments of the configuration file which are valid.
+       Args:
+            config_arguments (dict): Arguments specified in yaml file
+            choices (dict): valid values of choices for arguments
+       Returns:
+             valid_arguments (dict): Returns the valid arguments
+     """
+    grouped_arguments = {'state', 'duration', 'value'}
+    logged_error = False
+    valid_arguments = {}
+    for argument in config_arguments:
+        # if argument is present in grouped_arguments,
+        # all the associated arguments should also
+        # be specified in the config file
+        if argument not in grouped_arguments or \
+            (argument in grouped_arguments and
+             grouped_arguments.issubset(config_arguments.keys())):
+            config_value = config_arguments.get(argument)
+            if argument == 'jobs' and not is_positive_integer(config_value):
+                raise ValueError("Invalid value '%s' provided for 'jobs' in "
+                                 "config file: the number of jobs must be a "
+                                 "positive integer" % (config_value,))
+            if is_valid_choice(argument, config_value, choices):
+                valid_arguments[argument] = config_value
+            else:
+                log.warn("Invalid choice '%s' provided for '%s' in"
+                         " config file" %
+                         (config_value, argument))
+        elif not logged_error:
+            log.warn("Either no or all arguments (state, duration "
+                     "and value) are required in config file")
+            logged_error = True
+    return valid_arguments
+
+
+def is_positive_integer(value):
+    """
+       Checks if value is a positive integer, e.g. a number of jobs
+       Args:
+            value: argument value
+       Returns:
+             Returns boolean value
+     """
+    return isinstance(value, int) and not isinstance(value, bool) and \
+        value > 0
+
+
 def is_valid_choice(argument, value, choices):
     """
        Checks if value is valid choice or not for given argument
@@ -130,7 +300,8 @@ def is_valid_choice(argument, value, choices):
 def load_config_file(config_path):
     """
        Loads the configuration file from the user's home directory
-       or user specified location
+       or user specified location. The parsed configuration is kept for
+       the next calls of this process, until the file is modified.
        Args:
             config_path (str): Path to the configuration file
        Returns:
@@ -139,7 +310,19 @@ def load_config_file(config_path):
     if not os.path.exists(config_path):
         raise RuntimeError("No config file found at %s" % config_path)
 
+    key = _config_key(config_path)
+    cached = _configs.get(key[0])
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
     # read input from the config file for pull requests
+    with open(config_path, 'r') as f:
+        config = yaml.load(f, Loader=ConfigLoader)
+    if not isinstance(config, list):
+        _configs[key[0]] = (key, config)
+        return config
+
+    # keep the order of the old format, in case it's rewritten
     config = load_ordered_config(config_path)
     if isinstance(config, list):
         # convert to new format
@@ -163,8 +346,11 @@ def load_config_file(config_path):
             copyfile(config_path, backup_path)
             log.info("Rewriting %r in new format!" % config_path)
             with open(config_path, 'w') as f:
-                f.write(yaml.dump(config, default_flow_style=False))
+                f.write(yaml.dump(config, Dumper=ConfigDumper,
+                                  default_flow_style=False))
 
+    # not asked again until the file is modified, e.g. rewritten
+    _configs[key[0]] = (key, config)
     return config
 
 
@@ -199,25 +385,17 @@ def load_ordered_config(config_path):
             config(dict): Returns the configurations in the defined ordered
     """
 
-    #  To load data from yaml in ordered dict format
-    _mapping_tag = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
-
-    def dict_representer(dumper, data):
-        return dumper.represent_mapping(_mapping_tag, data.iteritems())
-
-    def dict_constructor(loader, node):
-        return collections.OrderedDict(loader.construct_pairs(node))
-
-    yaml.add_representer(collections.OrderedDict, dict_representer)
-    yaml.add_constructor(_mapping_tag, dict_constructor)
-
-    #  format the output to print a blank scalar rather than null
-    def represent_none(self, _):
-        return self.represent_scalar('tag:yaml.org,2002:null', u'')
-
-    yaml.add_representer(type(None), represent_none)
-
     # read input from home directory for pull requests
     with open(config_path, 'r') as f:
-        config = yaml.load(f)
+        config = yaml.load(f, Loader=OrderedConfigLoader)
     return config
+
+
+def _config_key(config_path):
+    """
+    Returns the key the parsed configuration is cached with, which
+    changes whenever the configuration file does.
+    """
+    path = os.path.abspath(config_path)
+    stat = os.stat(path)
+    return (path, stat.st_mtime, stat.st_size)
@@ -1,16 +1,385 @@
+import calendar
 import datetime
+import fnmatch
 import json
 import logging
+import sys
+import threading
 import time
 
 from collections import OrderedDict
 
 from dateutil.relativedelta import relativedelta
+import requests
+
+from reviewrot import httpcache
+from reviewrot.ratelimit import RateLimitAdapter
+
+try:
+    from queue import Queue, Full  # python3
+except ImportError:
+    from Queue import Queue, Full  # python2
+
+try:
+    from sys import intern  # python3
+except ImportError:
+    pass  # python2, where intern is a builtin
 
 log = logging.getLogger(__name__)
 
+# Margin by which the creation date bounds sent to git services are widened,
+# so that server-side filtering never drops a review the age filter accepts
+PUSHDOWN_SLACK = datetime.timedelta(days=1)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Shortest month, under which durations are counted in days only
+_MONTH_MIN = datetime.timedelta(days=28)
+
+# Time the ages of the review requests are computed from, shared by all the
+# services of a run so that their results are consistent
+_reference_time = None
+_age_filters = {}
+_reference_lock = threading.Lock()
+
+# Default number of connections kept open per host by the shared session
+DEFAULT_POOL_SIZE = 10
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+_host_semaphores = {}
+_host_lock = threading.Lock()
+
+
+def get_session(pool_size=None):
+    """
+    Returns the requests session shared by all HTTP based services, so
+    that every service reuses the same pool of keep-alive connections.
+    Args:
+        pool_size (int): Number of connections to keep open per host.
+                         The pool is only ever grown, never shrunk.
+    Returns:
+        session (requests.Session): shared session
+    """
+    global _session, _session_pool_size
+    with _session_lock:
+        if _session is None:
+            _session = requests.session()
+        if pool_size is None:
+            pool_size = DEFAULT_POOL_SIZE
+        if pool_size > _session_pool_size:
+            mount_pool(_session, pool_size)
+            _session_pool_size = pool_size
+        return _session
+
+
+def mount_pool(session, pool_size=None):
+    """
+    Mounts connection pools of the given size on a requests session.
+    Args:
+        session (requests.Session): session to tune
+        pool_size (int): Number of connections to keep open per host.
+                         Defaults to the size of the shared session pool.
+    """
+    if pool_size is None:
+        pool_size = max(_session_pool_size, DEFAULT_POOL_SIZE)
+    if httpcache.cache is not None:
+        adapter = httpcache.CachingAdapter(httpcache.cache,
+                                           pool_connections=pool_size,
+                                           pool_maxsize=pool_size)
+    else:
+        adapter = RateLimitAdapter(pool_connections=pool_size,
+                                   pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def prefetch(iterable, size=1):
+    """
+    Iterates over an iterable in a background thread, so that the next
+    items (e.g. the next page of a paginated API) are already being
+    fetched while the current one is processed.
+    Args:
+        iterable: iterable to consume
+        size (int): Number of items to fetch ahead
+    Returns:
+        generator yielding the items of the iterable, in order
+    """
+    queue = Queue(maxsize=size)
+    done = object()
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(('item', item)):
+                    return
+            _put(('done', done))
+        except Exception:
+            _put(('error', sys.exc_info()))
+
+    def _put(entry):
+        # give up once the consumer went away, instead of blocking forever
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            kind, item = queue.get()
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                raise item[1]
+            yield item
+    finally:
+        stopped.set()
+
+
+def host_semaphore(host, max_concurrency):
+    """
+    Returns the semaphore capping the number of repositories requested at
+    once from a host, by all the config entries of the host setting the
+    same limit.
+    Args:
+        host (str): host name
+        max_concurrency (int): size of the semaphore
+    Returns:
+        semaphore (threading.BoundedSemaphore): semaphore of the host and
+                                                limit
+    """
+    key = (host, max_concurrency)
+    with _host_lock:
+        if key not in _host_semaphores:
+            _host_semaphores[key] = threading.BoundedSemaphore(
+                max_concurrency)
+        return _host_semaphores[key]
+
+
+def map_repos(func, repos, max_concurrency=None, host=None):
+    """
+    Calls a function for every repository of a user/organization, with up
+    to max_concurrency calls running at once, and hands out every result
+    as soon as the ones of the previous repositories are out, so that
+    results come in the same order as a serial run would produce them.
+    Args:
+        func (callable): function requesting the reviews of a repository
+        repos (iterable): repositories
+        max_concurrency (int): Maximum number of calls to run at once, for
+                               this call and for the calls to the host
+                               with the same limit. Calls are made
+                               serially if None or 1.
+        host (str): host the repositories are requested from
+    Returns:
+        generator yielding the result of func for every repository
+    """
+    if not max_concurrency or max_concurrency <= 1:
+        for repo in repos:
+            yield func(repo)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    semaphore = host_semaphore(host, max_concurrency)
+
+    def call(repo):
+        with semaphore:
+            return func(repo)
+
+    pool = ThreadPool(max_concurrency)
+    try:
+        for result in pool.imap(call, repos):
+            yield result
+    finally:
+        # drop the repositories not requested yet if a call failed
+        pool.terminate()
+        pool.join()
+
+
+def match_repo(name, include=None, exclude=None):
+    """
+    Checks a repository name against the glob patterns of a config item,
+    e.g. 'review-*'.
+    Args:
+        name (str): repository name
+        include (list): patterns the name has to match one of, if any
+        exclude (list): patterns the name must not match
+    Returns:
+        True if the repository is selected, False otherwise
+    """
+    if include and not any(fnmatch.fnmatchcase(name, pattern)
+                           for pattern in include):
+        return False
+    return not any(fnmatch.fnmatchcase(name, pattern)
+                   for pattern in exclude or ())
+
+
+def reference_time():
+    """
+    Returns the time the ages of the review requests are computed from,
+    set once per run.
+    Returns:
+        now (datetime): reference time, in UTC
+    """
+    global _reference_time
+    with _reference_lock:
+        if _reference_time is None:
+            _reference_time = datetime.datetime.utcnow()
+        return _reference_time
+
+
+def reset_reference_time(now=None):
+    """
+    Sets the time the ages of the review requests are computed from,
+    e.g. before every refresh of a long running process.
+    Args:
+        now (datetime): new reference time, in UTC. Defaults to the
+                        current time.
+    """
+    global _reference_time
+    with _reference_lock:
+        _reference_time = now if now is not None \
+            else datetime.datetime.utcnow()
+        _age_filters.clear()
+
+
+def get_age_filter(state_, value, duration):
+    """
+    Returns the age filter for the given state, value and duration,
+    compiled once per reference time.
+    Args:
+        state_ (str): state for review requests, e.g, older
+                      or newer
+        value (int): The value in terms of duration for requests
+                     to be older or newer than
+        duration (str): The duration in terms of period(year, month, hour
+                        minute) for requests to be older or newer than
+    Returns:
+        age_filter (AgeFilter): compiled age filter
+    """
+    key = (state_, value, duration)
+    age_filter = _age_filters.get(key)
+    if age_filter is None:
+        age_filter = AgeFilter(state_, value, duration, reference_time())
+        _age_filters[key] = age_filter
+    return age_filter
+
+
+def _epoch(date):
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
+
+
+def _end_of_month(date):
+    days = calendar.monthrange(date.year, date.month)[1]
+    return date.replace(day=days, hour=23, minute=59, second=59,
+                        microsecond=999999)
+
+
+class AgeFilter(object):
+    """
+    Checks if review requests are older or newer than a time interval, by
+    comparing their creation date to a cutoff date computed once.
+    Years and months are counted the calendar way, as relativedelta
+    does. When the month the cutoff falls in and the current month have
+    different lengths, relativedelta clamps days to the end of the month,
+    so the review requests created in the rest of that month are checked
+    with relativedelta itself.
+    """
+    def __init__(self, state_, value, duration, now):
+        if state_ not in ('older', 'newer'):
+            raise ValueError('Invalid state value: %s' % state_)
+        self.state = state_
+        self.value = value
+        self.duration = duration
+        self.now = now
+        # (start, end] range of creation dates relativedelta is used for
+        self.window = None
+        if duration in ('y', 'm'):
+            months = value * 12 if duration == 'y' else value
+            if months <= 0:
+                # review requests created in the future only, keep
+                # relativedelta for all of them
+                self.cutoff = None
+                self.window = (datetime.datetime.min,
+                               datetime.datetime.max)
+            else:
+                self.cutoff = now - relativedelta(months=months)
+                if calendar.monthrange(self.cutoff.year,
+                                       self.cutoff.month)[1] != \
+                        calendar.monthrange(now.year, now.month)[1]:
+                    self.window = (self.cutoff, _end_of_month(self.cutoff))
+        elif duration == 'd':
+            self.cutoff = now - datetime.timedelta(days=value)
+        elif duration == 'h':
+            self.cutoff = now - datetime.timedelta(hours=value)
+        elif duration == 'min':
+            self.cutoff = now - datetime.timedelta(minutes=value)
+        else:
+            raise ValueError("Invalid duration type: %s" % duration)
+
+        if self.cutoff is not None:
+            self.cutoff_epoch = _epoch(self.cutoff)
+        # latest creation date a review request older than the interval
+        # can have
+        self.latest = self.window[1] if self.window is not None \
+            else self.cutoff
+
+    def accepts(self, created_at):
+        """
+        Checks if a review request is older or newer than the time interval.
+        Args:
+            created_at (datetime): the date review request was filed
+        Returns:
+            True if the review request is older or newer than
+            specified time interval, False otherwise
+        """
+        if self.window is not None and \
+                self.window[0] < created_at <= self.window[1]:
+            return self._accepts_calendar(created_at)
+        if self.state == 'older':
+            return created_at <= self.cutoff
+        return created_at > self.cutoff
+
+    def accepts_epochs(self, epochs):
+        """
+        Checks a batch of review requests at once.
+        Args:
+            epochs (iterable): creation dates of the review requests, in
+                               seconds since the epoch
+        Returns:
+            accepted (list): True for every review request older or newer
+                             than specified time interval, False otherwise
+        """
+        if self.window is None:
+            cutoff = self.cutoff_epoch
+            if self.state == 'older':
+                return [epoch <= cutoff for epoch in epochs]
+            return [epoch > cutoff for epoch in epochs]
+        return [self.accepts(datetime.datetime.utcfromtimestamp(epoch))
+                for epoch in epochs]
+
+    def _accepts_calendar(self, created_at):
+        rel_diff = relativedelta(self.now, created_at)
+        if self.duration == 'y':
+            older = rel_diff.years >= self.value
+        else:
+            older = (rel_diff.years * 12) + rel_diff.months >= self.value
+        return older if self.state == 'older' else not older
+
 
 class BaseService(object):
+    # Whether request_reviews accepts since to only return the reviews
+    # updated since then, closed ones included
+    supports_incremental = False
+
     def check_request_state(self, created_at,
                             state_, value, duration):
         """
@@ -31,62 +400,37 @@ class BaseService(object):
         """
         if state_ is not None and value is not None\
                 and duration is not None:
-            """
-            find the relative time difference between now and
-            review request filed to retrieve relative information
-            """
-            rel_diff = relativedelta(datetime.datetime.utcnow(),
-                                     created_at)
-            """
-            find the absolute time difference between now and
-            review request filed to retrieve absolute information
-            """
-            abs_diff = datetime.datetime.utcnow() - created_at
-
-            if state_ not in ('older', 'newer'):
-                raise ValueError('Invalid state value: %s' % state_)
-            if duration == 'y':
-                """ use rel_diff to retrieve absolute year since
-                value of absolute and relative year is same."""
-                if state_ == 'older' and rel_diff.years < value:
-                    return False
-                elif state_ == 'newer' and rel_diff.years >= value:
-                    return False
-            elif duration == 'm':
-                """ use rel_diff to calculate absolute time difference
-                in months """
-                abs_month = (rel_diff.years * 12) + rel_diff.months
-                if state_ == 'older' and abs_month < value:
-                    return False
-                elif state_ == 'newer' and abs_month >= value:
-                    return False
-            elif duration == 'd':
-                """ use abs_diff to retrieve absolute time difference
-                in days """
-                if state_ == 'older' and abs_diff.days < value:
-                    return False
-                elif state_ == 'newer' and abs_diff.days >= value:
-                    return False
-            elif duration == 'h':
-                """ use abs_diff to calculate absolute time difference
-                in hours """
-                abs_hour = abs_diff.total_seconds() / 3600
-                if state_ == 'older' and abs_hour < value:
-                    return False
-                elif state_ == 'newer' and abs_hour >= value:
-                    return False
-            elif duration == 'min':
-                """ use abs_diff to calculate absolute time difference
-                in minutes """
-                abs_min = abs_diff.total_seconds() / 60
-                if state_ == 'older' and abs_min < value:
-                    return False
-                elif state_ == 'newer' and abs_min >= value:
-                    return False
-            else:
-                raise ValueError("Invalid duration type: %s" % duration)
+            return get_age_filter(state_, value, duration).accepts(
+                created_at)
         return True
 
+    def get_created_bounds(self, state_, value, duration):
+        """
+        Returns bounds of the creation date of the review requests that
+        check_request_state can accept, so that git services can filter
+        review requests server-side. The bounds are slightly wider than
+        the filter, which must still be applied to the results.
+        Args:
+            state_ (str): state for review requests, e.g, older
+                          or newer
+            value (int): The value in terms of duration for requests
+                         to be older or newer than
+            duration (str): The duration in terms of period(year, month, hour
+                            minute) for requests to be older or newer than
+
+        Returns:
+            (created_after, created_before) tuple of datetimes, either of
+            them being None if unbounded
+        """
+        if state_ is None or value is None or duration is None:
+            return None, None
+        age_filter = get_age_filter(state_, value, duration)
+        if age_filter.cutoff is None:
+            return None, None
+        if state_ == 'older':
+            return None, age_filter.latest + PUSHDOWN_SLACK
+        return age_filter.cutoff - PUSHDOWN_SLACK, None
+
     def _decode_response(self, response):
         """
         Remove Gerrit's prefix and convert to JSON.
@@ -108,7 +452,8 @@ class BaseService(object):
         except ValueError:
             raise ValueError('Invalid json content: %s' % content)
 
-    def _call_api(self, url, method='GET', ssl_verify=True, ignore_err=False):
+    def _call_api(self, url, method='GET', ssl_verify=True, ignore_err=False,
+                  data=None):
         """
         Method used to call the API.
         It returns the raw JSON returned by the API or raises an exception
@@ -120,12 +465,13 @@ class BaseService(object):
             ssl_verify (bool/str): Whether or not to verify SSL certificates,
                                    or a path to a CA file to use.
             ignore_err(bool): raise exception if ignore_error is True
+            data (dict): JSON body of the request, if any
         Returns:
             raw JSON returned by API
         """
         decoded_response = ''
         try:
-            response = self.get_response(method, url, ssl_verify)
+            response = self.get_response(method, url, ssl_verify, data=data)
             decoded_response = response.json()
             # Some services (like pagure) return valid JSON with a 404 error.
             # https://pagure.io/api/0/username/reponame/pull-requests
@@ -146,7 +492,7 @@ class BaseService(object):
                 raise
         return decoded_response
 
-    def get_response(self, method, url, ssl_verify):
+    def get_response(self, method, url, ssl_verify, data=None):
         """
         Method used to make request.
         Args:
@@ -155,39 +501,120 @@ class BaseService(object):
             url(str): URL for git based service
             ssl_verify (bool/str): Whether or not to verify SSL certificates,
                                    or a path to a CA file to use.
+            data (dict): JSON body of the request, if any
         Returns:
             Output returned by request module
         """
         return self.session.request(method=method, url=url,
-                                    headers=self.header, verify=ssl_verify)
+                                    headers=self.header, verify=ssl_verify,
+                                    json=data)
+
+
+def _join_units(units):
+    """
+    Joins (unit, count) pairs into e.g. '2 days 1 hour', skipping the
+    units with a count of zero.
+    """
+    result = []
+    for k, v in units:
+        if v == 1:
+            result.append('%s %s' % (v, k))
+        elif v > 1:
+            result.append('%s %ss' % (v, k))
+    return ' '.join(result)
+
+
+def _intern(value):
+    """
+    Returns a single shared copy of a string, e.g. of a user name or an
+    avatar URL found in many reviews. Interned strings are freed along
+    with the last review using them.
+
+    Only native strings are interned: on python2, where the services
+    return unicode strings, which can't be interned, values are returned
+    as they are and reviews keep their own copies.
+    """
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+def _to_timestamp(date):
+    if date is None:
+        return None
+    return calendar.timegm(date.utctimetuple())
+
+
+def _from_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return _EPOCH + datetime.timedelta(seconds=timestamp)
 
 
 class BaseReview(object):
+    # reviews are kept in memory by the thousands, so they don't get an
+    # instance dict and store their dates as seconds since the epoch
+    __slots__ = ('user', 'title', 'url', 'timestamp', 'comments', 'image',
+                 'updated_timestamp', 'closed', '_since', '_epoch')
+
     def __init__(self, user=None, title=None, url=None,
-                 time=None, comments=None, image=None):
-        self.user = user
+                 time=None, comments=None, image=None,
+                 updated=None, closed=False):
+        self.user = _intern(user)
         self.title = title
         self.url = url
         self.time = time
         self.comments = comments
-        self.image = image
+        self.image = _intern(image)
+        self.updated = updated
+        self.closed = closed
+        # (reference time, duration) computed last
+        self._since = None
+
+    @property
+    def time(self):
+        return _from_timestamp(self.timestamp)
+
+    @time.setter
+    def time(self, time):
+        self.timestamp = _to_timestamp(time)
+        self._epoch = None
+
+    @property
+    def updated(self):
+        return _from_timestamp(self.updated_timestamp)
+
+    @updated.setter
+    def updated(self, updated):
+        self.updated_timestamp = _to_timestamp(updated)
 
     @staticmethod
-    def format_duration(created_at):
+    def format_duration(created_at, now=None):
         """
         Formats the duration the review request is pending for
         Args:
             created_at (str): the date review request was filed
+            now (datetime): time the duration is computed until. Defaults
+                            to the reference time of the run.
 
         Returns:
             a string of duration the review request is pending for
         """
+        if now is None:
+            now = reference_time()
+        diff = now - created_at
+        if datetime.timedelta(0) <= diff < _MONTH_MIN:
+            # less than a month, relativedelta would only count days,
+            # hours and minutes
+            hours, seconds = divmod(diff.seconds, 3600)
+            return _join_units((('day', diff.days), ('hour', hours),
+                                ('minute', seconds // 60)))
+
         """
         find the relative time difference between now and
         review request filed to retrieve relative information
         """
-        rel_diff = relativedelta(datetime.datetime.utcnow(),
-                                 created_at)
+        rel_diff = relativedelta(now, created_at)
 
         time_dict = OrderedDict([
             ('year', rel_diff.years),
@@ -197,18 +624,21 @@ class BaseReview(object):
             ('minute', rel_diff.minutes),
         ])
 
-        result = []
-        for k, v in time_dict.items():
-            if v == 1:
-                result.append('%s %s' % (v, k))
-            elif v > 1:
-                result.append('%s %ss' % (v, k))
-
-        return ' '.join(result)
+        return _join_units(time_dict.items())
 
     @property
     def since(self):
-        return self.format_duration(created_at=self.time)
+        now = reference_time()
+        if self._since is None or self._since[0] is not now:
+            self._since = (now, self.format_duration(created_at=self.time,
+                                                     now=now))
+        return self._since[1]
+
+    @property
+    def epoch(self):
+        if self._epoch is None:
+            self._epoch = time.mktime(self.time.timetuple())
+        return self._epoch
 
     def format(self, style, i, N):
         """
@@ -223,7 +653,6 @@ class BaseReview(object):
         lookup = {
             'oneline': self._format_oneline,
             'indented': self._format_indented,
-            'json': self._format_json,
         }
         return lookup[style](i, N)
 
@@ -269,27 +698,13 @@ class BaseReview(object):
 
         return string
 
-    def _format_json(self, i, N):
-        """
-        Format the result in json style.
-        Args:
-            i(int): position in a list.
-            N(int): length of the list.
-        Return:
-            fromatted_string(str): Formatted string as per style
-        """
-        import json
-        # Include a comma after every entry, except the last.
-        suffix = ',' if i < N - 1 else ''
-        return json.dumps(self.__json__(), indent=2) + suffix
-
     def __json__(self):
         return {
             'user': self.user,
             'title': self.title,
             'url': self.url,
             'relative_time': self.since,
-            'time': time.mktime(self.time.timetuple()),
+            'time': self.epoch,
             'comments': self.comments,
             'type': type(self).__name__,
             'image': self.image,
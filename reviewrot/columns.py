@@ -0,0 +1,130 @@
+from array import array
+
+
+class ReviewColumns(object):
+    """
+    Keeps reviews as parallel arrays, one per field, instead of one object
+    per review. Sorting and filtering work on the arrays directly, and
+    review objects are only rebuilt one at a time while iterating, e.g.
+    to write them to a report.
+    """
+    # names of the arrays, one per field
+    COLUMNS = ('types', 'users', 'titles', 'urls', 'timestamps',
+               'comments', 'images', 'updated', 'closed')
+
+    def __init__(self, reviews=()):
+        self.types = []
+        self.users = []
+        self.titles = []
+        self.urls = []
+        self.timestamps = array('d')
+        self.comments = []
+        self.images = []
+        # None when the service doesn't report it
+        self.updated = []
+        self.closed = array('b')
+        self.extend(reviews)
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        Joins several stores into one, in order.
+        Args:
+            parts (list): ReviewColumns to join
+        Returns:
+            columns (ReviewColumns): rows of all the parts
+        """
+        columns = cls()
+        for part in parts:
+            for name in cls.COLUMNS:
+                getattr(columns, name).extend(getattr(part, name))
+        return columns
+
+    def append(self, review):
+        """
+        Adds a review.
+        Args:
+            review (BaseReview): review to add
+        """
+        self.types.append(type(review))
+        self.users.append(review.user)
+        self.titles.append(review.title)
+        self.urls.append(review.url)
+        self.timestamps.append(review.timestamp)
+        self.comments.append(review.comments)
+        self.images.append(review.image)
+        self.updated.append(review.updated_timestamp)
+        self.closed.append(bool(review.closed))
+
+    def extend(self, reviews):
+        """
+        Adds several reviews.
+        Args:
+            reviews (iterable): reviews to add
+        """
+        for review in reviews:
+            self.append(review)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self.review(position)
+
+    def review(self, position):
+        """
+        Rebuilds the review at a position.
+        Args:
+            position (int): position of the review
+        Returns:
+            review (BaseReview): review object
+        """
+        review = self.types[position](user=self.users[position],
+                                      title=self.titles[position],
+                                      url=self.urls[position],
+                                      comments=self.comments[position],
+                                      image=self.images[position])
+        review.timestamp = int(self.timestamps[position])
+        review.updated_timestamp = self.updated[position]
+        review.closed = bool(self.closed[position])
+        return review
+
+    def select(self, positions):
+        """
+        Returns the reviews at the given positions, in that order.
+        Args:
+            positions (iterable): positions of the reviews
+        Returns:
+            columns (ReviewColumns): selected reviews
+        """
+        columns = ReviewColumns()
+        for position in positions:
+            for name in self.COLUMNS:
+                getattr(columns, name).append(getattr(self, name)[position])
+        return columns
+
+    def filter(self, age_filter):
+        """
+        Returns the reviews older or newer than a time interval.
+        Args:
+            age_filter (AgeFilter): compiled age filter
+        Returns:
+            columns (ReviewColumns): reviews accepted by the filter
+        """
+        accepted = age_filter.accepts_epochs(self.timestamps)
+        return self.select(position for position, accept
+                           in enumerate(accepted) if accept)
+
+    def sorted(self, reverse=False):
+        """
+        Returns the reviews sorted by creation date, keeping the order of
+        the reviews created at the same time.
+        Args:
+            reverse (bool): latest first if True
+        Returns:
+            columns (ReviewColumns): sorted reviews
+        """
+        return self.select(sorted(range(len(self)),
+                                  key=self.timestamps.__getitem__,
+                                  reverse=reverse))
@@ -1,12 +1,94 @@
+import json
 import logging
+import os
 import requests
+import threading
+import time
 
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
-from reviewrot.basereview import BaseReview, BaseService
+from reviewrot.basereview import BaseReview, BaseService, get_session
+from reviewrot.basereview import prefetch
 
 log = logging.getLogger(__name__)
 
+# Number of changes requested per page of a change query
+PAGE_SIZE = 100
+
+# Number of seconds added to age queries to make up for clock differences
+AGE_SLACK = 60
+
+# Maximum number of concurrent requests made to fetch comments of changes
+# on Gerrit versions which don't report total_comment_count
+COMMENTS_POOL_SIZE = 10
+
+# Number of seconds a host or project stays valid in the persistent
+# validation cache
+DEFAULT_VALIDATION_TTL = 24 * 60 * 60
+
+
+class ValidationCache(object):
+    """
+    Remembers the Gerrit hosts and projects which were found to be valid,
+    so that they are checked only once per run. If a path is given, the
+    cache is also persisted there and entries expire after ttl seconds.
+    """
+    def __init__(self, path=None, ttl=DEFAULT_VALIDATION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                log.warning('Ignoring corrupted validation cache %s', path)
+
+    def __contains__(self, key):
+        with self.lock:
+            validated = self.entries.get(key)
+        return validated is not None and \
+            (self.path is None or time.time() - validated < self.ttl)
+
+    def add(self, key):
+        """
+        Marks a host or project as valid.
+        Args:
+            key (str): host url or project url
+        """
+        with self.lock:
+            self.entries[key] = time.time()
+            if self.path is None:
+                return
+            tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+            try:
+                cache_dir = os.path.dirname(self.path)
+                if cache_dir and not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.entries, f)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError):
+                # the cache is only an optimization
+                log.debug('Could not persist the validation cache in %s',
+                          self.path, exc_info=True)
+
+
+validation_cache = ValidationCache()
+
+
+def configure_validation_cache(path=None, ttl=DEFAULT_VALIDATION_TTL):
+    """
+    Replaces the per-run validation cache with a persistent one.
+    Args:
+        path (str): Path of the file used to persist the cache
+        ttl (int): Number of seconds a validation stays valid
+    """
+    global validation_cache
+    validation_cache = ValidationCache(path, ttl)
+
 
 class GerritService(BaseService):
     """
@@ -14,12 +96,15 @@ class GerritService(BaseService):
         https://gerrit-review.googlesource.com/Documentation/rest-api.html
     """
     def __init__(self):
-        self.session = requests.session()
+        self.session = get_session()
         self.header = {'Accept': 'application/json'}
 
+    supports_incremental = True
+
     def request_reviews(self, host, repo_name, state_=None,
                         user_name=None, token=None, value=None,
-                        duration=None, ssl_verify=True):
+                        duration=None, ssl_verify=True, since=None,
+                        **kwargs):
         """
         Creates a Gerrit object.
         Requests pull requests for specified repo name.
@@ -36,25 +121,81 @@ class GerritService(BaseService):
             token (str): This will be None in case of Gerrit
             ssl_verify (bool/str): Whether or not to verify SSL certificates,
                                    or a path to a CA file to use.
+            since (datetime): If given, only changes updated since then
+                              are returned, closed ones included
         Returns:
             response (list): Returns list of list of pull requests for
                              specified repo name
         """
         self.url = host
-        reviews = None
-
-        if self.check_host_url(ssl_verify) and \
-                self.check_repo_exists(repo_name, ssl_verify):
-            request_url = "{}/changes/?q=project:{}+status:open&" \
-                          "o=DETAILED_ACCOUNTS".format(self.url, repo_name)
-            log.debug('Looking for change requests for %s -> %s',
-                      self.url, repo_name)
-            review_response = self._call_api(url=request_url,
-                                             ssl_verify=ssl_verify)
-            reviews = self.format_response(review_response, state_, value,
-                                           duration)
+        repo_url = "{}/projects/{}".format(self.url, repo_name)
+
+        if self.url not in validation_cache:
+            self.check_host_url(ssl_verify)
+            validation_cache.add(self.url)
+
+        if since is None:
+            query = "project:{}+status:open".format(repo_name)
+            # changes are updated when created, so the ones created within
+            # the age filter were updated within it as well
+            created_after, _ = self.get_created_bounds(state_, value,
+                                                       duration)
+            if created_after is not None:
+                age = datetime.utcnow() - created_after
+                query += "+-age:{}s".format(
+                    int(age.total_seconds()) + AGE_SLACK)
+        else:
+            # age is relative to the time of the query, allow some slack
+            age = datetime.utcnow() - since
+            query = "project:{}+-age:{}s".format(
+                repo_name, int(age.total_seconds()) + AGE_SLACK)
+        request_url = "{}/changes/?q={}&o=DETAILED_ACCOUNTS".format(
+            self.url, query)
+        log.debug('Looking for change requests for %s -> %s',
+                  self.url, repo_name)
+        reviews = []
+        found_changes = False
+        try:
+            for changes in prefetch(self.get_changes(request_url,
+                                                     ssl_verify)):
+                found_changes = found_changes or bool(changes)
+                reviews.extend(self.format_response(changes, state_, value,
+                                                    duration))
+        except ValueError:
+            # tell apart a missing project from any other error
+            self.check_repo_exists(repo_name, ssl_verify)
+            raise
+
+        # The query of a missing project gives no changes, so the project
+        # only needs to be checked when no changes were found for it.
+        if repo_url not in validation_cache:
+            if not found_changes:
+                self.check_repo_exists(repo_name, ssl_verify)
+            validation_cache.add(repo_url)
+
         return reviews
 
+    def get_changes(self, request_url, ssl_verify):
+        """
+        Walks through all the pages of a change query.
+        Args:
+            request_url (str): URL of the change query
+            ssl_verify (bool/str): Whether or not to verify SSL certificates,
+                                   or a path to a CA file to use.
+        Returns:
+            generator yielding the list of changes of every page
+        """
+        start = 0
+        while True:
+            changes = self._call_api(
+                url="{}&n={}&S={}".format(request_url, PAGE_SIZE, start),
+                ssl_verify=ssl_verify)
+            yield changes
+            # the last change of a page tells if more changes are available
+            if not changes or not changes[-1].get('_more_changes'):
+                return
+            start += len(changes)
+
     def check_repo_exists(self, repo_name, ssl_verify):
         """
         Check if repo exist in gerrit
@@ -117,6 +258,37 @@ class GerritService(BaseService):
 
         return total_comments
 
+    def get_comments_counts(self, changes):
+        """
+        Get the comments count of several changes at once.
+        Newer Gerrit versions report total_comment_count as part of the
+        change itself. For older versions, the comments of the remaining
+        changes are fetched concurrently.
+        Args:
+            changes (list): ChangeInfo entries returned by the change query
+        Returns:
+            comments (dict): Returns count of comments keyed by change id
+        """
+        comments = {}
+        missing = []
+        for change in changes:
+            if 'total_comment_count' in change:
+                comments[change['id']] = change['total_comment_count']
+            else:
+                missing.append(change['id'])
+
+        if len(missing) == 1:
+            comments[missing[0]] = self.get_comments_count(missing[0])
+        elif missing:
+            pool = ThreadPool(min(COMMENTS_POOL_SIZE, len(missing)))
+            try:
+                counts = pool.map(self.get_comments_count, missing)
+            finally:
+                pool.close()
+                pool.join()
+            comments.update(zip(missing, counts))
+        return comments
+
     def format_response(self, decoded_responses, state_, value, duration):
         """
         Formats the pull requests details and print it on console.
@@ -132,8 +304,17 @@ class GerritService(BaseService):
         Returns:
              res_(list): Returns list of pull requests for specified repo name.
         """
-        res_ = []
+        changes = []
+        closed = []
         for decoded_response in decoded_responses:
+            updated = datetime.strptime(decoded_response['updated'][:-3],
+                                        "%Y-%m-%d %H:%M:%S.%f")
+            change_url = "{}/{}".format(self.url,
+                                        str(decoded_response['_number']))
+            if decoded_response.get('status', 'NEW') != 'NEW':
+                closed.append(GerritReview(url=change_url, updated=updated,
+                                           closed=True))
+                continue
             created_date = datetime.strptime(decoded_response['created'][:-3],
                                              "%Y-%m-%d %H:%M:%S.%f")
             result = self.check_request_state(created_date, state_, value,
@@ -142,18 +323,24 @@ class GerritService(BaseService):
                 log.debug("Change request '%s' is not %s than specified "
                           "time interval", decoded_response['subject'], state_)
                 continue
+            changes.append((decoded_response, change_url, created_date,
+                            updated))
+
+        comments = self.get_comments_counts(
+            [change[0] for change in changes])
+
+        res_ = closed
+        for decoded_response, change_url, created_date, updated in changes:
             owner = decoded_response['owner']
-            change_number = decoded_response['_number']
             res = GerritReview(user=owner.get('username', owner.get('email')),
                                title=decoded_response['subject'],
-                               url="{}/{}".format(self.url,
-                                                  str(change_number)),
+                               url=change_url,
                                time=created_date,
-                               comments=self.get_comments_count(
-                                   decoded_response['id']),
+                               comments=comments[decoded_response['id']],
                                # XXX - I don't know how to find gerrit avatars
                                # for now.  Can we figure this out later?
-                               image=GerritReview.logo)
+                               image=GerritReview.logo,
+                               updated=updated)
             res_.append(res)
         return res_
 
@@ -161,4 +348,4 @@ class GerritService(BaseService):
 class GerritReview(BaseReview):
     # XXX - Here just until we figure out how to do gerrit avatars.
     logo = 'http://electric-cloud.com/wp-content/uploads/2014/09/EC-Gerrit.png'
-    pass
+    __slots__ = ()
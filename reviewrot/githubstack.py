@@ -1,18 +1,185 @@
+import datetime
 import logging
-from reviewrot.basereview import BaseService, BaseReview
+import threading
+from itertools import chain
+from reviewrot import repocache
+from reviewrot.basereview import BaseService, BaseReview, get_session
+from reviewrot.basereview import map_repos, match_repo
 from github import Github
 from github.GithubException import UnknownObjectException
+from github.Requester import Requester
 
 log = logging.getLogger(__name__)
 
+# GraphQL endpoint of the public github instance
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+# Number of repositories requested per page of a user/organization
+GRAPHQL_REPOS_PER_PAGE = 25
+
+# Number of pull requests requested along with every repository
+GRAPHQL_PULLS_PER_REPO = 50
+
+# Number of pull requests requested per page of a single repository
+GRAPHQL_PULLS_PER_PAGE = 100
+
+GRAPHQL_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Only the fields GithubReview needs. The review comment count of a pull
+# request is the sum of the comments of its reviews.
+GRAPHQL_PULL_FIELDS = """
+fragment pullFields on PullRequest {
+  title
+  url
+  createdAt
+  updatedAt
+  author { login avatarUrl }
+  reviews(first: 100) { nodes { comments { totalCount } } }
+}
+"""
+
+GRAPHQL_OWNER_QUERY = """
+query($owner: String!, $cursor: String, $direction: OrderDirection!) {
+  repositoryOwner(login: $owner) {
+    repositories(first: %d, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        name
+        isArchived
+        pullRequests(states: OPEN, first: %d,
+                     orderBy: {field: CREATED_AT, direction: $direction}) {
+          pageInfo { hasNextPage endCursor }
+          nodes { ...pullFields }
+        }
+      }
+    }
+  }
+}
+""" % (GRAPHQL_REPOS_PER_PAGE, GRAPHQL_PULLS_PER_REPO) + GRAPHQL_PULL_FIELDS
+
+GRAPHQL_REPO_QUERY = """
+query($owner: String!, $name: String!, $cursor: String,
+      $direction: OrderDirection!) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: %d, after: $cursor,
+                 orderBy: {field: CREATED_AT, direction: $direction}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...pullFields }
+    }
+  }
+}
+""" % GRAPHQL_PULLS_PER_PAGE + GRAPHQL_PULL_FIELDS
+
+
+class GithubConnection(object):
+    """
+    Connection class of PyGithub sending its requests through the session
+    shared by all HTTP based services, so that they get its keep-alive
+    connections, its rate limit scheduling and its HTTP cache.
+    """
+    protocol = 'https'
+    default_port = 443
+
+    # mimic the httplib connection object, like PyGithub's own classes
+    def __init__(self, host, port=None, strict=False, timeout=None,
+                 **kwargs):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.verify = kwargs.get('verify', True)
+
+    def request(self, verb, url, input, headers, stream=False):
+        self.verb = verb
+        self.url = url
+        self.input = input
+        self.headers = headers
+        self.stream = stream
+
+    def getresponse(self):
+        netloc = self.host
+        if self.port and self.port != self.default_port:
+            netloc = '%s:%s' % (self.host, self.port)
+        # PyGithub sets the Authorization header itself, which must not be
+        # replaced with credentials from ~/.netrc
+        response = get_session().request(
+            self.verb, '%s://%s%s' % (self.protocol, netloc, self.url),
+            headers=self.headers, data=self.input, timeout=self.timeout,
+            verify=self.verify, allow_redirects=False, stream=self.stream,
+            auth=lambda request: request)
+        return GithubConnectionResponse(response)
+
+    def close(self):
+        # the shared session stays open for the other requests
+        pass
+
+
+class GithubHTTPConnection(GithubConnection):
+    """
+    Connection class of PyGithub for github enterprise servers over HTTP.
+    """
+    protocol = 'http'
+    default_port = 80
+
+
+class GithubConnectionResponse(object):
+    """
+    Response of a GithubConnection, mimicking the httplib response object.
+    """
+    def __init__(self, response):
+        self.status = response.status_code
+        self.headers = response.headers
+        self.response = response
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.response.text or ''
+
+    def iter_content(self, chunk_size=1):
+        return self.response.iter_content(chunk_size=chunk_size)
+
+
+# PyGithub picks its connection classes when a github object is created,
+# for the whole process: every github object created from now on sends its
+# requests through the shared session. Its retries and pool settings are
+# replaced with the ones of the session, which retries throttled requests.
+Requester.injectConnectionClasses(GithubHTTPConnection, GithubConnection)
+
 
 class GithubService(BaseService):
     """
     This class represents Github. The reference can be found here:
     https://developer.github.com/v3/
     """
+    supports_incremental = True
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.session = get_session()
+        self.header = None
+
+    def get_client(self, token):
+        """
+        Returns the github object for a token, created on first use and
+        reused for the rest of the run.
+
+        Args:
+            token (str): Github token for authentication
+        Returns:
+            github object
+        """
+        with self.lock:
+            if token not in self.clients:
+                self.clients[token] = Github(token)
+                log.debug('Github instance created: %s', self.clients[token])
+            return self.clients[token]
+
     def request_reviews(self, user_name, repo_name=None, state_=None,
                         value=None, duration=None, token=None, host=None,
+                        since=None, ssl_verify=True, graphql=False,
+                        include=None, exclude=None, max_concurrency=None,
                         **kwargs):
         """
         Creates a github object.
@@ -33,14 +200,32 @@ class GithubService(BaseService):
             token (str): Github token for authentication
             host (str): Github host name (This value is not yet supported.
                         Default behavior is to use public github instance.)
+            since (datetime): If given, only pull requests updated since
+                              then are returned, closed ones included
+            ssl_verify (bool/str): Whether or not to verify SSL certificates,
+                                   or a path to a CA file to use.
+                                   Only used by the GraphQL API.
+            graphql (bool): Request the pull requests with the GraphQL API
+                            instead of the REST API
+            include (list): glob patterns the names of the repositories of
+                            the user/organization have to match one of
+            exclude (list): glob patterns the names of the repositories of
+                            the user/organization must not match
+            max_concurrency (int): Maximum number of repositories of the
+                                   user/organization requested at once
+                                   from the host
         Returns:
             response (list): Returns list of list of pull requests for
                              specified username and reponame or all reponame
                              for given username
         """
+        if graphql and since is None:
+            return self.request_reviews_graphql(
+                user_name=user_name, repo_name=repo_name, state_=state_,
+                value=value, duration=duration, token=token, host=host,
+                ssl_verify=ssl_verify, include=include, exclude=exclude)
         # get authenticated github object
-        g = Github(token)
-        log.debug('Github instance created: %s', g)
+        g = self.get_client(token)
         try:
             # get user object
             uname = g.get_user(user_name)
@@ -53,30 +238,100 @@ class GithubService(BaseService):
             # get pull requests for specified username and repo name
             res = self.get_reviews(uname=uname, repo_name=repo_name,
                                    state_=state_, value=value,
-                                   duration=duration)
+                                   duration=duration, since=since)
             # extend incase of a non empty result
             if res:
                 response.extend(res)
         else:
             # get all of the respositories for specified user/organization
-            repo_list = uname.get_repos()
+            repo_list = self.list_repos(uname, user_name, host)
             if not repo_list:
                 log.debug("No repositories found for user name %s", user_name)
             """
             list pull requests for all of the repositories for specified
             user/organization
             """
-            for repo in repo_list:
-                res = self.get_reviews(uname=uname, repo_name=repo.name,
-                                       state_=state_, value=value,
-                                       duration=duration)
+            repos = self._select_repos(repo_list, user_name, since, include,
+                                       exclude)
+            for res in map_repos(
+                    lambda repo: self.get_reviews(
+                        uname=uname, repo_name=repo.name, state_=state_,
+                        value=value, duration=duration, since=since),
+                    repos, max_concurrency, host or 'github.com'):
                 # extend incase of a non empty result
                 if res:
                     response.extend(res)
         return response
 
+    def _select_repos(self, repo_list, user_name, since=None, include=None,
+                      exclude=None):
+        """
+        Yields the repositories of a user/organization whose pull requests
+        are requested.
+        """
+        for repo in repo_list:
+            if self.select_repo(repo, since, include, exclude):
+                yield repo
+            else:
+                log.debug('Skipping repository %s/%s', user_name, repo.name)
+
+    @staticmethod
+    def list_repos(uname, user_name, host=None):
+        """
+        Lists the repositories of a user/organization, from the repository
+        cache if it is enabled. Only the names and archived flags are
+        cached, the other metadata being outdated as soon as a pull
+        request is opened.
+
+        Args:
+            uname (NamedUser): Github user or organization
+            user_name (str): Github username or organization name
+            host (str): Github host name
+        Returns:
+            repo_list (list): repositories of the user/organization
+        """
+        if repocache.cache is None:
+            return uname.get_repos()
+
+        key = repocache.RepoCache.key('github', host, user_name)
+        repos, cached = repocache.cache.get(
+            key, uname.get_repos,
+            lambda repo: {'name': repo.name, 'archived': repo.archived})
+        if not cached:
+            # listed by this call, with up to date metadata
+            return repos
+        return [repocache.CachedRepo(repo) for repo in repos]
+
+    @staticmethod
+    def select_repo(repo, since=None, include=None, exclude=None):
+        """
+        Checks from the metadata returned along with the repositories of a
+        user/organization whether a repository can have pull requests to
+        report, so that the ones which can't are never requested.
+
+        Args:
+            repo (Repository): repository listed for a user/organization
+            since (datetime): If given, pull requests updated since then
+                              are requested, closed ones included
+            include (list): glob patterns the name has to match one of
+            exclude (list): glob patterns the name must not match
+        Returns:
+            True if the pull requests of the repository are requested
+        """
+        if not match_repo(repo.name, include, exclude):
+            return False
+        if since is not None:
+            # pull requests closed since then are still reported
+            return True
+        if repo.archived:
+            return False
+        # the count of open issues includes the open pull requests, and
+        # is 0 for empty repositories. It isn't cached, as it would hide
+        # the pull requests opened since the repositories were listed.
+        return getattr(repo, 'open_issues_count', None) != 0
+
     def get_reviews(self, uname, repo_name, state_=None,
-                    value=None, duration=None):
+                    value=None, duration=None, since=None):
         """
         Fetches pull requests for specified username and repo name.
         Formats the pull requests details and print it on console.
@@ -92,6 +347,8 @@ class GithubService(BaseService):
             duration (str): The duration in terms of period(year,
                             month, hour, minute) for requests to be
                             older or newer than
+            since (datetime): If given, only pull requests updated since
+                              then are returned, closed ones included
         Returns:
             res_ (list): Returns list of pull requests for specified
                          username and repo name
@@ -106,13 +363,39 @@ class GithubService(BaseService):
                             % (repo_name, uname.login))
         log.debug('Looking for pull requests for %s -> %s/%s ',
                   'github', uname.login, repo_name)
-        # get list of open pull requests for a given repository
-        pull_requests = repo.get_pulls()
+        created_after, created_before = self.get_created_bounds(
+            state_, value, duration)
+        if since is None:
+            # get list of open pull requests for a given repository, in the
+            # order of creation matching the age filter, so that listing
+            # can stop at the first one out of its bounds
+            direction = 'asc' if created_before is not None else 'desc'
+            pull_requests = repo.get_pulls(sort='created',
+                                           direction=direction)
+        else:
+            # get the most recently updated pull requests first, so that
+            # listing can stop at the first one not updated since then
+            pull_requests = repo.get_pulls(state='all', sort='updated',
+                                           direction='desc')
         if not pull_requests:
             log.debug('No open pull requests found for %s/%s ',
                       uname.login, repo_name)
         res_ = []
         for pr in pull_requests:
+            if since is not None:
+                if pr.updated_at < since:
+                    break
+                if pr.state != 'open':
+                    res_.append(GithubReview(url=pr.html_url,
+                                             updated=pr.updated_at,
+                                             closed=True))
+                    continue
+            elif created_after is not None and \
+                    pr.created_at < created_after:
+                break
+            elif created_before is not None and \
+                    pr.created_at > created_before:
+                break
             """ check if review request is older/newer than specified time
             interval"""
             result = self.check_request_state(pr.created_at,
@@ -128,11 +411,211 @@ class GithubService(BaseService):
                                url=pr.html_url,
                                time=pr.created_at,
                                comments=pr.review_comments,
-                               image=pr.user.avatar_url)
+                               image=pr.user.avatar_url,
+                               updated=pr.updated_at)
+            log.debug(res)
+            res_.append(res)
+        return res_
+
+    def request_reviews_graphql(self, user_name, repo_name=None, state_=None,
+                                value=None, duration=None, token=None,
+                                host=None, ssl_verify=True, include=None,
+                                exclude=None):
+        """
+        Requests the open pull requests for specified username and repo
+        name with the GraphQL API. If repo name is not provided, the pull
+        requests of all the repositories of the user/organization are
+        requested along with the repositories, a page of repositories at a
+        time, so that most of them need no other request.
+
+        Args:
+            user_name (str): Github username or organization name
+            repo_name (str): Github repository name for specified
+                             username or organization
+            state_ (str): The filter state for pull requests, e.g, older
+                          or newer
+            value (int): The value in terms of duration for requests
+                         to be older or newer than
+            duration (str): The duration in terms of period(year, month, hour,
+                            minute) for requests to be older or newer than
+            token (str): Github token for authentication
+            host (str): Github Enterprise host name, None for the public
+                        github instance
+            ssl_verify (bool/str): Whether or not to verify SSL certificates,
+                                   or a path to a CA file to use.
+            include (list): glob patterns the names of the repositories of
+                            the user/organization have to match one of
+            exclude (list): glob patterns the names of the repositories of
+                            the user/organization must not match
+        Returns:
+            response (list): Returns list of pull requests for specified
+                             username and reponame or all reponame for
+                             given username
+        """
+        self.header = {'Authorization': 'bearer %s' % token}
+        url = GRAPHQL_URL if host is None \
+            else '%s/api/graphql' % host.rstrip('/')
+        created_after, created_before = self.get_created_bounds(
+            state_, value, duration)
+        # same order of creation as the REST API, so that listing can stop
+        # at the first pull request out of the bounds of the age filter
+        direction = 'ASC' if created_before is not None else 'DESC'
+
+        if repo_name is not None:
+            repos = [(repo_name, self._graphql_pulls(
+                url, user_name, repo_name, direction, ssl_verify))]
+        else:
+            repos = self._graphql_repos(url, user_name, direction, ssl_verify,
+                                        include, exclude)
+
+        response = []
+        for name, pull_requests in repos:
+            log.debug('Looking for pull requests for %s -> %s/%s ',
+                      'github', user_name, name)
+            response.extend(self.format_graphql_pulls(
+                pull_requests, state_, value, duration,
+                created_after, created_before))
+        return response
+
+    def _graphql_repos(self, url, user_name, direction, ssl_verify,
+                       include=None, exclude=None):
+        """
+        Yields the repositories of a user/organization, along with their
+        open pull requests, skipping archived ones and the ones not
+        selected by the include/exclude glob patterns.
+        Returns:
+            generator yielding (repo name, pull request nodes) tuples,
+            where the nodes are only requested past the first page if
+            they are iterated over
+        """
+        cursor = None
+        while True:
+            data = self._graphql(url, GRAPHQL_OWNER_QUERY,
+                                 {'owner': user_name, 'cursor': cursor,
+                                  'direction': direction},
+                                 ssl_verify)
+            owner = data.get('repositoryOwner')
+            if owner is None:
+                log.debug('Invalid username/organizaton: %s', user_name)
+                raise Exception('Invalid username/organizaton: %s'
+                                % user_name)
+            repositories = owner['repositories']
+            if not repositories['nodes']:
+                log.debug("No repositories found for user name %s",
+                          user_name)
+            for repo in repositories['nodes']:
+                if repo['isArchived'] or \
+                        not match_repo(repo['name'], include, exclude):
+                    log.debug('Skipping repository %s/%s', user_name,
+                              repo['name'])
+                    continue
+                pulls = repo['pullRequests']
+                nodes = pulls['nodes']
+                if pulls['pageInfo']['hasNextPage']:
+                    nodes = chain(nodes, self._graphql_pulls(
+                        url, user_name, repo['name'], direction, ssl_verify,
+                        cursor=pulls['pageInfo']['endCursor']))
+                yield repo['name'], nodes
+            if not repositories['pageInfo']['hasNextPage']:
+                break
+            cursor = repositories['pageInfo']['endCursor']
+
+    def _graphql_pulls(self, url, user_name, repo_name, direction,
+                       ssl_verify, cursor=None):
+        """
+        Yields the open pull requests of a repository, requesting the
+        next page only once the previous one is iterated over.
+        Returns:
+            generator yielding pull request nodes
+        """
+        while True:
+            data = self._graphql(url, GRAPHQL_REPO_QUERY,
+                                 {'owner': user_name, 'name': repo_name,
+                                  'cursor': cursor, 'direction': direction},
+                                 ssl_verify)
+            if data.get('repository') is None:
+                log.debug('Repository %s not found for user %s',
+                          repo_name, user_name)
+                raise Exception('Repository %s not found for user %s'
+                                % (repo_name, user_name))
+            pulls = data['repository']['pullRequests']
+            for node in pulls['nodes']:
+                yield node
+            if not pulls['pageInfo']['hasNextPage']:
+                break
+            cursor = pulls['pageInfo']['endCursor']
+
+    def _graphql(self, url, query, variables, ssl_verify):
+        """
+        Runs a GraphQL query.
+        Args:
+            url (str): GraphQL endpoint
+            query (str): GraphQL query
+            variables (dict): variables of the query
+            ssl_verify (bool/str): Whether or not to verify SSL certificates,
+                                   or a path to a CA file to use.
+        Returns:
+            data (dict): data returned by the query
+        """
+        response = self._call_api(url, method='POST', ssl_verify=ssl_verify,
+                                  data={'query': query,
+                                        'variables': variables})
+        if response.get('errors'):
+            messages = '; '.join(error.get('message', '')
+                                 for error in response['errors'])
+            log.debug('GraphQL query failed: %s', messages)
+            raise Exception('GraphQL query failed: %s' % messages)
+        return response['data']
+
+    def format_graphql_pulls(self, pull_requests, state_, value, duration,
+                             created_after=None, created_before=None):
+        """
+        Formats the pull requests returned by the GraphQL API.
+        Args:
+            pull_requests (iterable): pull request nodes, in the order of
+                                      creation matching the age filter
+            state_ (str): The filter state for pull requests, e.g, older
+                          or newer
+            value (int): The value in terms of duration for requests
+                         to be older or newer than
+            duration (str): The duration in terms of period(year, month, hour,
+                            minute) for requests to be older or newer than
+            created_after (datetime): stop at the first pull request
+                                      created before then
+            created_before (datetime): stop at the first pull request
+                                       created after then
+        Returns:
+            res_ (list): Returns list of GithubReview
+        """
+        res_ = []
+        for pr in pull_requests:
+            created_at = datetime.datetime.strptime(pr['createdAt'],
+                                                    GRAPHQL_DATE_FORMAT)
+            if created_after is not None and created_at < created_after:
+                break
+            if created_before is not None and created_at > created_before:
+                break
+            if not self.check_request_state(created_at,
+                                            state_, value, duration):
+                log.debug("review request '%s' is not %s than specified"
+                          " time interval", pr['title'], state_)
+                continue
+            # deleted accounts are shown as the ghost user by github
+            author = pr.get('author') or {'login': 'ghost', 'avatarUrl': None}
+            res = GithubReview(
+                user=author['login'],
+                title=pr['title'],
+                url=pr['url'],
+                time=created_at,
+                comments=sum(review['comments']['totalCount']
+                             for review in pr['reviews']['nodes']),
+                image=author['avatarUrl'],
+                updated=datetime.datetime.strptime(pr['updatedAt'],
+                                                   GRAPHQL_DATE_FORMAT))
             log.debug(res)
             res_.append(res)
         return res_
 
 
 class GithubReview(BaseReview):
-    pass
\ No newline at end of file
+    __slots__ = ()
\ No newline at end of file
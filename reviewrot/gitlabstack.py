@@ -2,21 +2,83 @@ import os
 import logging
 import gitlab
 import datetime
-from reviewrot.basereview import BaseService, BaseReview
+import threading
+from reviewrot import repocache
+from reviewrot.basereview import BaseService, BaseReview, mount_pool
+from reviewrot.basereview import map_repos, match_repo, prefetch
 from gitlab.exceptions import GitlabGetError
 from distutils.version import LooseVersion
 
 log = logging.getLogger(__name__)
 
+# Number of items requested per page of a listing
+PAGE_SIZE = 100
+
 
 class GitlabService(BaseService):
     """
     This class represents Gitlab. The reference can be found here:
      https://docs.gitlab.com/ee/api/
     """
+    supports_incremental = True
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get_client(self, host, token, ssl_verify=True):
+        """
+        Returns an authenticated gitlab object, created on first use and
+        reused for the rest of the run, so that the version detection and
+        authentication are done only once.
+
+        Args:
+            host (str): Gitlab host name for authentication
+            token (str): Gitlab token for authentication
+            ssl_verify (bool/str): Whether or not to verify SSL certificates,
+                                   or a path to a CA file to use.
+        Returns:
+            gitlab object
+        """
+        key = (host, token, ssl_verify)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = self._create_client(host, token,
+                                                        ssl_verify)
+            return self.clients[key]
+
+    @staticmethod
+    def _create_client(host, token, ssl_verify):
+        """
+        Creates an authenticated gitlab object.
+        """
+        gl = gitlab.Gitlab(host, token, ssl_verify=ssl_verify)
+
+        # Test GitLab version and fall back to API v3 if possible, as a
+        # workaround to 404 Errors produced by authentication on some
+        # GitLab instances
+        try:
+            gl_version = gl.version()
+        except ValueError:
+            # Some instances have thrown a ValueError instead of failing
+            # gracefully when queried for version
+            gl_version = ('unknown', 'unknown')
+        if (gl_version == ('unknown', 'unknown') or
+           LooseVersion(gl_version[0]) < LooseVersion('9.0')):
+            # GitLab API v3 was deprecated in GitLab v9.0
+            gl = gitlab.Gitlab(host, token, ssl_verify=ssl_verify,
+                               api_version=3)
+
+        if getattr(gl, 'session', None) is not None:
+            mount_pool(gl.session)
+        gl.auth()
+        log.debug('Gitlab instance created: %s', gl)
+        return gl
+
     def request_reviews(self, user_name, repo_name=None, state_=None,
                         value=None, duration=None, token=None, host=None,
-                        ssl_verify=True, **kwargs):
+                        ssl_verify=True, since=None, include=None,
+                        exclude=None, max_concurrency=None, **kwargs):
         """
         Creates a gitlab object.
         Requests merge requests for specified username and repo name.
@@ -38,30 +100,21 @@ class GitlabService(BaseService):
             host (str): Gitlab host name for authentication
             ssl_verify (bool/str): Whether or not to verify SSL certificates,
                                    or a path to a CA file to use.
+            since (datetime): If given, only merge requests updated since
+                              then are returned, closed ones included
+            include (list): glob patterns the names of the projects of the
+                            group have to match one of
+            exclude (list): glob patterns the names of the projects of the
+                            group must not match
+            max_concurrency (int): Maximum number of projects of the group
+                                   requested at once from the host, with
+                                   API v3
         Returns:
             response (list): Returns the list of pull requests for
                              specified user(group) name and projectname or all
                              projectname for given groupname
         """
-        gl = gitlab.Gitlab(host, token, ssl_verify=ssl_verify)
-
-        # Test GitLab version and fall back to API v3 if possible, as a
-        # workaround to 404 Errors produced by authentication on some
-        # GitLab instances
-        try:
-            gl_version = gl.version()
-        except ValueError:
-            # Some instances have thrown a ValueError instead of failing
-            # gracefully when queried for version
-            gl_version = ('unknown', 'unknown')
-        if (gl_version == ('unknown', 'unknown') or
-           LooseVersion(gl_version[0]) < LooseVersion('9.0')):
-            # GitLab API v3 was deprecated in GitLab v9.0
-            gl = gitlab.Gitlab(host, token, ssl_verify=ssl_verify,
-                               api_version=3)
-
-        gl.auth()
-        log.debug('Gitlab instance created: %s', gl)
+        gl = self.get_client(host, token, ssl_verify)
         response = []
         # if Repository name is explicitly provided
         if repo_name is not None:
@@ -76,35 +129,207 @@ class GitlabService(BaseService):
             # get merge requests for specified username and project name
             res = self.get_reviews(uname=user_name, project=project,
                                    state_=state_, value=value,
-                                   duration=duration)
+                                   duration=duration, since=since)
             # extend in case of a non empty result
             if res:
                 response.extend(res)
 
         else:
             # get user object
-            groups = gl.groups.search(user_name)
+            groups = self.search_groups(gl, user_name, host)
             if not groups:
                 log.debug('Invalid user/group name: %s', user_name)
                 raise Exception('Invalid user/group name: %s' % user_name)
 
-            # get merge requests for all projects for specified group
+            seen = set()
             for group in groups:
-                projects = gl.group_projects.list(group_id=group.id)
-                if not projects:
-                    log.debug("No projects found for user/group name %s",
-                              user_name)
-                for project in projects:
-                    res = self.get_reviews(uname=user_name, project=project,
-                                           state_=state_, value=value,
-                                           duration=duration)
-                # extend in case of a non empty result
-                if res:
-                    response.extend(res)
+                if str(getattr(gl, 'api_version', '3')) == '3':
+                    # API v3 has no group merge requests, so get merge
+                    # requests for all projects for specified group
+                    res = self.get_projects_reviews(
+                        gl=gl, uname=user_name, group=group, state_=state_,
+                        value=value, duration=duration, since=since,
+                        include=include, exclude=exclude,
+                        max_concurrency=max_concurrency, host=host)
+                else:
+                    res = self.get_group_reviews(
+                        uname=user_name, group=group, state_=state_,
+                        value=value, duration=duration, since=since,
+                        include=include, exclude=exclude)
+                for review in res:
+                    # search can match both a group and its subgroups,
+                    # whose merge requests are then listed twice
+                    if review.url not in seen:
+                        seen.add(review.url)
+                        response.append(review)
         return response
 
+    @staticmethod
+    def search_groups(gl, user_name, host=None):
+        """
+        Searches the groups matching a group name, from the repository
+        cache if it is enabled. The cache is only used with API v4, where
+        merge requests are listed per group.
+
+        Args:
+            gl (Gitlab): gitlab object
+            user_name (str): Gitlab group name
+            host (str): Gitlab host name
+        Returns:
+            groups (list): matching groups
+        """
+        if repocache.cache is None or \
+                str(getattr(gl, 'api_version', '3')) == '3':
+            return gl.groups.search(user_name)
+
+        key = repocache.RepoCache.key('gitlab', host, user_name)
+        groups, cached = repocache.cache.get(
+            key, lambda: gl.groups.search(user_name),
+            lambda group: {'id': group.id})
+        if not cached:
+            return groups
+        # lazy objects are only used to build the URLs of the group
+        return [gl.groups.get(group['id'], lazy=True) for group in groups]
+
+    def get_projects_reviews(self, gl, uname, group, state_=None,
+                             value=None, duration=None, since=None,
+                             include=None, exclude=None,
+                             max_concurrency=None, host=None):
+        """
+        Fetches merge requests of every project of a group, one project
+        at a time.
+
+        Args:
+            gl (Gitlab): gitlab object
+            uname (str): Gitlab namespace
+            group (Group): Gitlab group
+            state_ (str): The state for pull requests, e.g, older
+                        or newer
+            value (str): The value in terms of duration for requests
+                         to be older or newer than
+            duration (str): The duration in terms of period(year, month,
+                            hour, minute) for requests to be older or
+                            newer than.
+            since (datetime): If given, only merge requests updated since
+                              then are returned, closed ones included
+            include (list): glob patterns the names of the projects have
+                            to match one of
+            exclude (list): glob patterns the names of the projects must
+                            not match
+            max_concurrency (int): Maximum number of projects requested
+                                   at once from the host
+            host (str): Gitlab host name
+
+        Returns:
+            res_ (list): Returns list of pull requests for all projects
+                         of the group
+        """
+        projects = gl.group_projects.list(group_id=group.id,
+                                          per_page=PAGE_SIZE, all=True)
+        if not projects:
+            log.debug("No projects found for user/group name %s", uname)
+        created_after, _ = self.get_created_bounds(state_, value, duration)
+        selected = []
+        for project in projects:
+            if self.select_project(project, since, created_after,
+                                   include, exclude):
+                selected.append(project)
+            else:
+                log.debug('Skipping project %s/%s', uname, project.path)
+        res_ = []
+        for res in map_repos(
+                lambda project: self.get_reviews(
+                    uname=uname, project=project, state_=state_,
+                    value=value, duration=duration, since=since),
+                selected, max_concurrency, host):
+            # extend in case of a non empty result
+            if res:
+                res_.extend(res)
+        return res_
+
+    def select_project(self, project, since=None, created_after=None,
+                       include=None, exclude=None):
+        """
+        Checks from the metadata returned along with the projects of a
+        group whether a project can have merge requests to report, so
+        that the ones which can't are never requested.
+
+        Args:
+            project (Project): project listed for a group
+            since (datetime): If given, merge requests updated since then
+                              are requested, closed ones included
+            created_after (datetime): if given, only merge requests created
+                                      after then are requested
+            include (list): glob patterns the name has to match one of
+            exclude (list): glob patterns the name must not match
+        Returns:
+            True if the merge requests of the project are requested
+        """
+        if not match_repo(project.path, include, exclude):
+            return False
+        if since is not None:
+            # merge requests closed since then are still reported
+            return True
+        if getattr(project, 'archived', False) or \
+                getattr(project, 'empty_repo', False) or \
+                getattr(project, 'merge_requests_enabled', True) is False:
+            return False
+        last_activity_at = getattr(project, 'last_activity_at', None)
+        # opening a merge request is an activity of the project, so
+        # projects inactive since the age bound have no newer ones
+        return created_after is None or not last_activity_at or \
+            self._parse_date(last_activity_at) >= created_after
+
+    def get_group_reviews(self, uname, group, state_=None,
+                          value=None, duration=None, since=None,
+                          include=None, exclude=None):
+        """
+        Fetches merge requests of a group and its subgroups at once,
+        using the group merge requests API.
+
+        Args:
+            uname (str): Gitlab namespace
+            group (Group): Gitlab group
+            state_ (str): The state for pull requests, e.g, older
+                        or newer
+            value (str): The value in terms of duration for requests
+                         to be older or newer than
+            duration (str): The duration in terms of period(year, month,
+                            hour, minute) for requests to be older or
+                            newer than.
+            since (datetime): If given, only merge requests updated since
+                              then are returned, closed ones included
+            include (list): glob patterns the names of the projects have
+                            to match one of
+            exclude (list): glob patterns the names of the projects must
+                            not match
+
+        Returns:
+            res_ (list): Returns list of pull requests for all projects
+                         of the group
+        """
+        log.debug('Looking for merge requests for group %s', uname)
+        # the group merge requests API already leaves out the ones of
+        # archived projects
+        filters = self._filters(state_, value, duration, since)
+        merge_requests = group.mergerequests.list(per_page=PAGE_SIZE,
+                                                  as_list=False, **filters)
+        if not merge_requests:
+            log.debug('No open merge requests found for group %s ', uname)
+        if include or exclude:
+            project_ids = set(
+                project.id for project in group.projects.list(
+                    per_page=PAGE_SIZE, as_list=False,
+                    include_subgroups=True)
+                if match_repo(project.path, include, exclude))
+            merge_requests = (mr for mr in merge_requests
+                              if mr.project_id in project_ids)
+        return self.format_merge_requests(
+            prefetch(merge_requests, size=PAGE_SIZE), state_, value,
+            duration)
+
     def get_reviews(self, uname, project, state_=None,
-                    value=None, duration=None):
+                    value=None, duration=None, since=None):
         """
         Fetches merge requests for specified username(groupname)
         and repo(project) name.
@@ -121,6 +346,8 @@ class GitlabService(BaseService):
             duration (str): The duration in terms of period(year, month,
                             hour, minute) for requests to be older or
                             newer than.
+            since (datetime): If given, only merge requests updated since
+                              then are returned, closed ones included
 
         Returns:
             res_ (list): Returns list of pull requests for specified
@@ -130,19 +357,79 @@ class GitlabService(BaseService):
                   uname, project.name)
 
         # get list of open merge requests for a given repository(project)
+        filters = self._filters(state_, value, duration, since)
         merge_requests = project.mergerequests.list(project_id=project.id,
-                                                    state='opened')
+                                                    per_page=PAGE_SIZE,
+                                                    as_list=False, **filters)
         if not merge_requests:
             log.debug('No open merge requests found for %s/%s ',
                       uname, project.name)
+        return self.format_merge_requests(
+            prefetch(merge_requests, size=PAGE_SIZE), state_, value,
+            duration)
+
+    def _filters(self, state_, value, duration, since):
+        """
+        Returns the filters used to list merge requests: open ones within
+        the bounds of the age filter, or all the ones updated since a
+        given time.
+        """
+        if since is not None:
+            return {'updated_after': self._format_date(since)}
+        filters = {'state': 'opened'}
+        created_after, created_before = self.get_created_bounds(
+            state_, value, duration)
+        if created_after is not None:
+            filters['created_after'] = self._format_date(created_after)
+        if created_before is not None:
+            filters['created_before'] = self._format_date(created_before)
+        return filters
+
+    @staticmethod
+    def _format_date(date):
+        """
+        Formats a date for the Gitlab API.
+        """
+        return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    @staticmethod
+    def _parse_date(date):
+        """
+        Parses a date returned by the Gitlab API.
+        """
+        try:
+            return datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%fZ')
+        except ValueError:
+            return datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ')
+
+    def format_merge_requests(self, merge_requests, state_=None,
+                              value=None, duration=None):
+        """
+        Formats the merge requests details.
+
+        Args:
+            merge_requests (list): Gitlab merge request objects
+            state_ (str): The state for pull requests, e.g, older
+                        or newer
+            value (str): The value in terms of duration for requests
+                         to be older or newer than
+            duration (str): The duration in terms of period(year, month,
+                            hour, minute) for requests to be older or
+                            newer than.
+
+        Returns:
+            res_ (list): Returns list of pull requests, closed ones
+                         being only flagged as such
+        """
         res_ = []
         for mr in merge_requests:
-            try:
-                mr_date = datetime.datetime.strptime(
-                    mr.created_at, '%Y-%m-%dT%H:%M:%S.%fZ')
-            except ValueError:
-                mr_date = datetime.datetime.strptime(
-                    mr.created_at, '%Y-%m-%dT%H:%M:%SZ')
+            updated = self._parse_date(mr.updated_at) \
+                if getattr(mr, 'updated_at', None) else None
+            if getattr(mr, 'state', 'opened') != 'opened':
+                res_.append(GitlabReview(url=mr.web_url, updated=updated,
+                                         closed=True))
+                continue
+            mr_date = self._parse_date(mr.created_at)
             """ check if review request is older/newer than specified time
             interval"""
             result = self.check_request_state(mr_date,
@@ -158,7 +445,8 @@ class GitlabService(BaseService):
                                comments=mr.user_notes_count,
                                # XXX - I don't know how to find gitlab avatars
                                # for now.  Can we figure this out later?
-                               image=GitlabReview.logo)
+                               image=GitlabReview.logo,
+                               updated=updated)
             log.debug(res)
             res_.append(res)
         return res_
@@ -167,4 +455,4 @@ class GitlabService(BaseService):
 class GitlabReview(BaseReview):
     # XXX - Here just until we figure out how to do gitlab avatars.
     logo = 'https://docs.gitlab.com/assets/images/gitlab-logo.svg'
-    pass
+    __slots__ = ()
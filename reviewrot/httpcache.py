@@ -0,0 +1,242 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from reviewrot.ratelimit import RateLimitAdapter
+
+log = logging.getLogger(__name__)
+
+# Default maximum size of the cache on disk, in megabytes
+DEFAULT_MAX_SIZE = 100
+
+# Default number of seconds a cached response is kept for revalidation
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# Request headers which make the same URL return different content
+_VARY_HEADERS = ('Authorization', 'PRIVATE-TOKEN', 'Accept')
+
+# Response headers which describe the transfer rather than the content
+_TRANSFER_HEADERS = ('content-encoding', 'content-length',
+                     'transfer-encoding', 'connection')
+
+cache = None
+
+
+class HTTPCache(object):
+    """
+    Stores response bodies along with their ETag and Last-Modified headers
+    in a directory, so that later requests to the same URL can be made
+    conditional. The least recently used entries are evicted once the
+    cache grows over max_size megabytes.
+    """
+    def __init__(self, path, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size * 1024 * 1024
+        self.lock = threading.Lock()
+        self.size = 0
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.size = sum(os.path.getsize(os.path.join(path, name))
+                            for name in os.listdir(path))
+        except (IOError, OSError):
+            # the cache is only an optimization
+            log.debug('Could not open the HTTP cache in %s', path,
+                      exc_info=True)
+
+    @staticmethod
+    def key(request):
+        """
+        Returns the cache key of a request.
+        Args:
+            request (PreparedRequest): request to be sent
+        Returns:
+            key (str): hash of the url and of the headers the content
+                       depends on
+        """
+        digest = hashlib.sha256(request.url.encode('utf-8'))
+        for header in _VARY_HEADERS:
+            value = request.headers.get(header)
+            if value:
+                digest.update(('\n%s: %s' % (header, value)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached entry for a key.
+        Args:
+            key (str): cache key
+        Returns:
+            entry (tuple): (metadata, body) tuple, or None if nothing
+                           usable is cached
+        """
+        meta_path = os.path.join(self.path, key + '.json')
+        body_path = os.path.join(self.path, key + '.body')
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - meta['stored'] > self.ttl:
+            return None
+        # keep track of the last use for the LRU eviction
+        try:
+            os.utime(meta_path, None)
+        except (IOError, OSError):
+            log.debug('Could not mark %s as used', meta_path, exc_info=True)
+        return meta, body
+
+    def set(self, key, response):
+        """
+        Stores a response.
+        Args:
+            key (str): cache key
+            response (Response): response to store
+        """
+        headers = CaseInsensitiveDict(response.headers)
+        for header in _TRANSFER_HEADERS:
+            headers.pop(header, None)
+        meta = {
+            'stored': time.time(),
+            'headers': dict(headers),
+            'encoding': response.encoding,
+        }
+        body = response.content
+        meta_path = os.path.join(self.path, key + '.json')
+        body_path = os.path.join(self.path, key + '.body')
+        old_size = self._entry_size(key)
+        tmp_suffix = '.%s.%s.tmp' % (os.getpid(),
+                                     threading.current_thread().ident)
+        try:
+            with open(body_path + tmp_suffix, 'wb') as f:
+                f.write(body)
+            with open(meta_path + tmp_suffix, 'w') as f:
+                json.dump(meta, f)
+            os.rename(body_path + tmp_suffix, body_path)
+            os.rename(meta_path + tmp_suffix, meta_path)
+        except (IOError, OSError):
+            # the cache is only an optimization
+            log.debug('Could not store the response in the HTTP cache %s',
+                      self.path, exc_info=True)
+            for tmp_path in (body_path + tmp_suffix, meta_path + tmp_suffix):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return
+        with self.lock:
+            self.size += self._entry_size(key) - old_size
+            if self.size > self.max_size:
+                self._evict()
+
+    def _entry_size(self, key):
+        size = 0
+        for suffix in ('.json', '.body'):
+            try:
+                size += os.path.getsize(os.path.join(self.path, key + suffix))
+            except OSError:
+                pass
+        return size
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache fits
+        in three quarters of its maximum size.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                key = name[:-len('.json')]
+                try:
+                    used = os.path.getmtime(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((used, key))
+        entries.sort()
+        for _, key in entries:
+            if self.size <= self.max_size * 3 / 4:
+                break
+            self.size -= self._entry_size(key)
+            for suffix in ('.json', '.body'):
+                try:
+                    os.remove(os.path.join(self.path, key + suffix))
+                except OSError:
+                    pass
+        log.debug('HTTP cache evicted down to %s bytes', self.size)
+
+
+class CachingAdapter(RateLimitAdapter):
+    """
+    Transport adapter which revalidates cached GET responses with
+    If-None-Match and If-Modified-Since, and serves the cached body
+    when the server answers 304 Not Modified.
+    """
+    def __init__(self, cache, **kwargs):
+        self.cache = cache
+        super(CachingAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super(CachingAdapter, self).send(request, **kwargs)
+
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry is not None:
+            headers = CaseInsensitiveDict(entry[0]['headers'])
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = \
+                    headers['Last-Modified']
+
+        response = super(CachingAdapter, self).send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            log.debug('Using cached response for %s', request.url)
+            response.close()
+            return self._cached_response(request, response, *entry)
+        if response.status_code == 200 and \
+                ('ETag' in response.headers or
+                 'Last-Modified' in response.headers):
+            self.cache.set(key, response)
+        return response
+
+    def _cached_response(self, request, not_modified, meta, body):
+        """
+        Builds a response out of a cached entry.
+        """
+        response = Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        # the 304 carries the up to date headers, e.g. rate limits
+        for header, value in not_modified.headers.items():
+            if header.lower() not in _TRANSFER_HEADERS:
+                response.headers[header] = value
+        response._content = body
+        response.encoding = meta['encoding']
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
+def configure(path, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+    """
+    Enables the HTTP cache for every session set up afterwards.
+    Args:
+        path (str): Directory in which responses are stored
+        ttl (int): Number of seconds a cached response is kept
+        max_size (int): Maximum size of the cache, in megabytes
+    """
+    global cache
+    cache = HTTPCache(path, ttl, max_size)
@@ -0,0 +1,162 @@
+import datetime
+import json
+import logging
+import os
+
+from reviewrot.basereview import BaseReview
+
+log = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Version of the state file format
+STATE_VERSION = 1
+
+
+def _format_date(date):
+    return date.strftime(DATE_FORMAT) if date is not None else None
+
+
+def _parse_date(date):
+    return datetime.datetime.strptime(date, DATE_FORMAT) \
+        if date is not None else None
+
+
+def _review_classes():
+    """
+    Returns the review classes of the loaded git services, by name.
+    """
+    classes = {}
+    pending = [BaseReview]
+    while pending:
+        cls = pending.pop()
+        classes[cls.__name__] = cls
+        pending.extend(cls.__subclasses__())
+    return classes
+
+
+class ReviewState(object):
+    """
+    Keeps the open reviews of every repository between runs, along with
+    the time of the most recent update seen for each of them, so that only
+    the reviews updated since then need to be requested.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.repos = {}
+        self.updated_keys = set()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    state = json.load(f)
+            except ValueError:
+                log.warning('Ignoring corrupted state file %s', path)
+            else:
+                if state.get('version') == STATE_VERSION:
+                    self.repos = state['repos']
+
+    @staticmethod
+    def key(git_type, host, user_name, repo_name):
+        """
+        Returns the key identifying a config entry in the state file.
+        Args:
+            git_type (str): type of the git service
+            host (str): host of the git service
+            user_name (str): user, group or namespace name
+            repo_name (str): repository name
+        Returns:
+            key (str): key of the config entry
+        """
+        return '%s|%s|%s/%s' % (git_type, host or '', user_name or '',
+                                repo_name or '')
+
+    def since(self, key):
+        """
+        Returns the most recent update seen for a config entry.
+        Args:
+            key (str): key of the config entry
+        Returns:
+            since (datetime): time to request updates from, or None if
+                              all the open reviews need to be requested
+        """
+        return _parse_date(self.repos.get(key, {}).get('watermark'))
+
+    def update(self, key, reviews, incremental):
+        """
+        Merges the reviews returned by a git service into the state.
+        Args:
+            key (str): key of the config entry
+            reviews (list): reviews returned by the git service
+            incremental (bool): True if the reviews are only the ones
+                                updated since the watermark, closed ones
+                                included, False if they are all the open
+                                reviews
+        Returns:
+            reviews (list): Returns all the open reviews of the config entry
+        """
+        stored = self.repos.get(key, {})
+        watermark = self.since(key) if incremental else None
+        if incremental:
+            open_reviews = dict(
+                (review['url'], review)
+                for review in stored.get('reviews', []))
+        else:
+            open_reviews = {}
+
+        for review in reviews:
+            if review.updated is not None and \
+                    (watermark is None or review.updated > watermark):
+                watermark = review.updated
+            if review.closed:
+                open_reviews.pop(review.url, None)
+            else:
+                open_reviews[review.url] = self._dump(review)
+
+        self.repos[key] = {
+            'watermark': _format_date(watermark),
+            'reviews': sorted(open_reviews.values(),
+                              key=lambda review: review['url']),
+        }
+        self.updated_keys.add(key)
+        classes = _review_classes()
+        return [self._load(review, classes)
+                for review in self.repos[key]['reviews']]
+
+    def save(self):
+        """
+        Writes the state of the config entries of this run to the state
+        file, replacing it atomically.
+        """
+        state = {
+            'version': STATE_VERSION,
+            'repos': dict((key, self.repos[key])
+                          for key in self.updated_keys),
+        }
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.path)
+
+    @staticmethod
+    def _dump(review):
+        return {
+            'type': type(review).__name__,
+            'user': review.user,
+            'title': review.title,
+            'url': review.url,
+            'time': _format_date(review.time),
+            'comments': review.comments,
+            'image': review.image,
+            'updated': _format_date(review.updated),
+        }
+
+    @staticmethod
+    def _load(review, classes):
+        cls = classes.get(review['type'], BaseReview)
+        return cls(user=review['user'],
+                   title=review['title'],
+                   url=review['url'],
+                   time=_parse_date(review['time']),
+                   comments=review['comments'],
+                   image=review['image'],
+                   updated=_parse_date(review['updated']))
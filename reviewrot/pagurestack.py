@@ -8,16 +8,18 @@ try:
 except ImportError:
     from urllib import urlencode  # python2
 
-import requests
-
-from reviewrot.basereview import BaseReview, BaseService
+from reviewrot.basereview import BaseReview, BaseService, get_session
+from reviewrot.basereview import prefetch
 
 log = logging.getLogger(__name__)
 
+# Number of pull requests requested per page
+PAGE_SIZE = 100
+
 
 class PagureService(BaseService):
     def __init__(self):
-        self.session = requests.session()
+        self.session = get_session()
         self.instance = "https://pagure.io"
         self.header = None
 
@@ -67,10 +69,50 @@ class PagureService(BaseService):
                                                              repo_name)
             log.debug('Looking for pull requests for %s -> %s',
                       'pagure.io', repo_name)
-        log.debug('Calling API with request_url: %s', request_url)
-        response = self._call_api(url=request_url, ssl_verify=ssl_verify)
         res_ = []
-        for res in response['requests']:
+        for requests_ in prefetch(self.get_pull_requests(request_url,
+                                                         ssl_verify)):
+            res_.extend(self.format_response(requests_, state_, value,
+                                             duration))
+        return res_
+
+    def get_pull_requests(self, request_url, ssl_verify):
+        """
+        Walks through all the pages of pull requests.
+
+        Args:
+            request_url (str): URL of the pull requests API of a project
+            ssl_verify (bool/str): Whether or not to verify SSL certificates,
+                                   or a path to a CA file to use.
+        Returns:
+            generator yielding the list of pull requests of every page
+        """
+        request_url = "{}?page=1&per_page={}".format(request_url, PAGE_SIZE)
+        while request_url:
+            log.debug('Calling API with request_url: %s', request_url)
+            response = self._call_api(url=request_url, ssl_verify=ssl_verify)
+            yield response['requests']
+            # older pagure versions don't paginate pull requests
+            request_url = (response.get('pagination') or {}).get('next')
+
+    def format_response(self, pull_requests, state_, value, duration):
+        """
+        Formats the pull requests details.
+
+        Args:
+            pull_requests (list): Pull requests returned by the Pagure API
+            state_ (str): The filter(state) for pull requests, e.g, older
+                          or newer
+            value (int): The value in terms of duration for requests
+                         to be older or newer than
+            duration (str): The duration in terms of period(year, month,
+                            hour, minute) for requests to be older or
+                            newer than
+        Returns:
+            res_ (list): Returns list of pull requests
+        """
+        res_ = []
+        for res in pull_requests:
             # if namespace exists in response
             try:
                 repo_reference = os.path.join(res['project']['namespace'],
@@ -103,11 +145,20 @@ class PagureService(BaseService):
                                url=url,
                                time=date,
                                comments=len(res['comments']),
-                               image=self._avatar(res['user']['name']))
+                               image=self._avatar(res['user']['name']),
+                               updated=self._updated(res))
             log.debug(res)
             res_.append(res)
         return res_
 
+    @staticmethod
+    def _updated(pull_request):
+        """ Return the date a pull request was last updated, if known. """
+        if pull_request.get('last_updated'):
+            return datetime.datetime.utcfromtimestamp(
+                int(pull_request['last_updated']))
+        return None
+
     @staticmethod
     def _avatar(username):
         """ Return the avatar of a given pagure user.
@@ -121,4 +172,4 @@ class PagureService(BaseService):
 
 
 class PagureReview(BaseReview):
-    pass
\ No newline at end of file
+    __slots__ = ()
\ No newline at end of file
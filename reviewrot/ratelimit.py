@@ -0,0 +1,234 @@
+import logging
+import threading
+import time
+
+from email.utils import mktime_tz, parsedate_tz
+
+try:
+    from urllib.parse import urlparse  # python3
+except ImportError:
+    from urlparse import urlparse  # python2
+
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+log = logging.getLogger(__name__)
+
+# Fraction of the budget below which requests are made one at a time and
+# spread over the time left until the budget is reset
+LOW_BUDGET = 0.1
+
+# Maximum number of times a throttled request is retried
+MAX_RETRIES = 3
+
+# Number of seconds waited before retrying a throttled request, when the
+# server doesn't tell
+DEFAULT_RETRY_DELAY = 60
+
+# Number of seconds added to reset times to make up for clock differences
+RESET_SLACK = 1
+
+# Headers of the budget, as sent by github and gitlab
+_BUDGET_HEADERS = (
+    ('X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset'),
+    ('RateLimit-Limit', 'RateLimit-Remaining', 'RateLimit-Reset'),
+)
+
+# Request headers identifying the budget a request is counted against
+_AUTH_HEADERS = ('Authorization', 'PRIVATE-TOKEN')
+
+_rate_limits = {}
+_rate_limits_lock = threading.Lock()
+
+
+class RateLimit(object):
+    """
+    Tracks the request budget of a (host, credentials) pair, as reported by
+    the server, and schedules the requests made against it: requests are
+    made freely while the budget lasts, one at a time and evenly spread
+    until the reset once it runs low, and not at all until the reset once
+    it is exhausted.
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.active = 0
+        self.last = 0
+        self.condition = threading.Condition()
+
+    def update(self, limit, remaining, reset):
+        """
+        Sets the budget left.
+        Args:
+            limit (int): number of requests allowed per period
+            remaining (int): number of requests left until the reset
+            reset (float): time the budget is reset at, in seconds since
+                           the epoch
+        """
+        with self.condition:
+            self.limit = limit
+            self.remaining = remaining
+            self.reset = reset
+            self.condition.notify_all()
+
+    def update_from_headers(self, headers):
+        """
+        Sets the budget left from the headers of a response, if any.
+        Args:
+            headers (dict): response headers
+        """
+        for names in _BUDGET_HEADERS:
+            try:
+                limit, remaining, reset = [int(headers[name])
+                                           for name in names]
+            except (KeyError, ValueError):
+                continue
+            # some servers send the number of seconds until the reset
+            if reset < 1000000000:
+                reset += time.time()
+            self.update(limit, remaining, reset)
+            return
+
+    def throttled(self, delay):
+        """
+        Stops the requests for a while, after the server refused one.
+        Args:
+            delay (float): number of seconds to wait
+        """
+        with self.condition:
+            self.remaining = 0
+            self.reset = max(self.reset or 0, time.time() + delay)
+
+    def acquire(self):
+        """
+        Waits until a request can be made.
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.remaining is not None and self.remaining <= 0:
+                    if self.reset is not None and now < self.reset:
+                        delay = self.reset - now + RESET_SLACK
+                        log.warning('Request budget of %s exhausted, '
+                                    'waiting %d seconds', self.name, delay)
+                        self.condition.wait(delay)
+                        continue
+                    # past the reset, the next response tells the budget
+                    self.remaining = None
+                if self._low(now):
+                    if self.active > 0:
+                        self.condition.wait()
+                        continue
+                    delay = self.last + (self.reset - now) / \
+                        max(self.remaining, 1) - now
+                    if delay > 0:
+                        self.condition.wait(delay)
+                        continue
+                break
+            self.active += 1
+            self.last = now
+            if self.remaining is not None:
+                self.remaining -= 1
+
+    def release(self):
+        """
+        Marks a request made with acquire as done.
+        """
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def _low(self, now):
+        return self.limit and self.remaining is not None and \
+            self.reset is not None and self.reset > now and \
+            self.remaining < self.limit * LOW_BUDGET
+
+
+def get_rate_limit(host, credentials=None):
+    """
+    Returns the rate limit of a host and credentials, shared by all the
+    services and clients of the run.
+    Args:
+        host (str): host name
+        credentials (str): value of the authentication header, if any
+    Returns:
+        rate_limit (RateLimit): rate limit of the host and credentials
+    """
+    key = (host, credentials)
+    with _rate_limits_lock:
+        if key not in _rate_limits:
+            _rate_limits[key] = RateLimit(host)
+        return _rate_limits[key]
+
+
+def retry_delay(status_code, headers, now=None):
+    """
+    Returns the number of seconds to wait before retrying a request which
+    was refused because of a rate limit.
+    Args:
+        status_code (int): status code of the response
+        headers (dict): headers of the response
+        now (float): current time, in seconds since the epoch
+    Returns:
+        delay (float): number of seconds to wait, or None if the request
+                       was not refused because of a rate limit
+    """
+    headers = CaseInsensitiveDict(headers)
+    retry_after = headers.get('Retry-After')
+    exhausted = headers.get('X-RateLimit-Remaining') == '0' or \
+        headers.get('RateLimit-Remaining') == '0'
+    if status_code != 429 and \
+            not (status_code == 403 and
+                 (retry_after is not None or exhausted)):
+        return None
+
+    if now is None:
+        now = time.time()
+    if retry_after is not None:
+        try:
+            return max(int(retry_after), 0)
+        except ValueError:
+            date = parsedate_tz(retry_after)
+            if date is not None:
+                return max(mktime_tz(date) - now, 0)
+    for name in ('X-RateLimit-Reset', 'RateLimit-Reset'):
+        try:
+            reset = int(headers[name])
+        except (KeyError, ValueError):
+            continue
+        return reset if reset < 1000000000 else max(reset - now, 0)
+    return DEFAULT_RETRY_DELAY
+
+
+class RateLimitAdapter(HTTPAdapter):
+    """
+    Transport adapter scheduling the requests of a session with the rate
+    limit of their host and credentials, and retrying the requests refused
+    because of a rate limit once it is reset.
+    """
+    def send(self, request, **kwargs):
+        credentials = None
+        for header in _AUTH_HEADERS:
+            if request.headers.get(header):
+                credentials = '%s: %s' % (header, request.headers[header])
+                break
+        rate_limit = get_rate_limit(urlparse(request.url).netloc,
+                                    credentials)
+
+        for attempt in range(MAX_RETRIES + 1):
+            rate_limit.acquire()
+            try:
+                response = super(RateLimitAdapter, self).send(request,
+                                                              **kwargs)
+            finally:
+                rate_limit.release()
+            rate_limit.update_from_headers(response.headers)
+            delay = retry_delay(response.status_code, response.headers)
+            if delay is None or attempt == MAX_RETRIES:
+                return response
+            log.warning('Request to %s refused by rate limit, retrying in '
+                        '%d seconds', request.url, delay)
+            rate_limit.throttled(delay)
+            response.close()
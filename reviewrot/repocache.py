@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Default number of seconds a repository listing is used before it is
+# listed again
+DEFAULT_TTL = 60 * 60
+
+# Default number of seconds after which a listing is listed again before
+# being used, since runs may exit before listing it in the background
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+# Version of the cache file format
+CACHE_VERSION = 1
+
+cache = None
+
+
+class RepoCache(object):
+    """
+    Keeps the repositories listed for the users, organizations and groups
+    of the config entries, per (git service, host, owner), along with the
+    metadata which doesn't change as reviews are opened, like whether they
+    are archived. Listings older than ttl seconds are still returned right
+    away, while they are listed again in the background for the next
+    requests, and listings older than max_age seconds are listed again
+    before being returned. If a path is given, the cache is also persisted
+    there.
+    """
+    def __init__(self, path=None, ttl=DEFAULT_TTL, refresh=False,
+                 max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.ttl = ttl
+        self.max_age = max_age
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.entries = {}
+        # keys listed again by this process, in the background or because
+        # a refresh was forced
+        self.refreshing = set()
+        self.refreshed = set()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    state = json.load(f)
+            except ValueError:
+                log.warning('Ignoring corrupted repository cache %s', path)
+            else:
+                if state.get('version') == CACHE_VERSION:
+                    self.entries = state['entries']
+
+    @staticmethod
+    def key(git_type, host, owner):
+        """
+        Returns the key identifying the listing of an owner.
+        Args:
+            git_type (str): type of the git service
+            host (str): host of the git service
+            owner (str): user, organization or group name
+        Returns:
+            key (str): key of the listing
+        """
+        return '%s|%s|%s' % (git_type, host or '', owner)
+
+    def get(self, key, fetch, dump=None):
+        """
+        Returns the repositories of an owner. They are listed with fetch
+        if they are not cached yet, if a refresh is forced, or if the
+        cached listing is older than max_age seconds, and in the
+        background if it is older than ttl seconds.
+        Args:
+            key (str): key of the listing
+            fetch (callable): function listing the repositories
+            dump (callable): function returning the JSON serializable item
+                             cached for a listed repository, the repository
+                             itself if None
+        Returns:
+            (repos, cached) tuple, where repos are the repositories
+            returned by fetch if cached is False, and their cached items
+            otherwise
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            forced = self.refresh and key not in self.refreshed
+            age = time.time() - entry['time'] if entry is not None else None
+            if entry is not None and not forced and age < self.max_age:
+                if age >= self.ttl and key not in self.refreshing:
+                    self.refreshing.add(key)
+                    # a daemon thread, so that runs never wait for it: if
+                    # it doesn't finish, a later run lists them again
+                    thread = threading.Thread(target=self._refresh,
+                                              args=(key, fetch, dump))
+                    thread.daemon = True
+                    thread.start()
+                return entry['repos'], True
+
+        log.debug('Listing repositories for %s', key)
+        repos = list(fetch())
+        self._set(key, self._dump(repos, dump))
+        return repos, False
+
+    def _refresh(self, key, fetch, dump):
+        """
+        Lists the repositories of an owner again, keeping the cached
+        listing if that fails.
+        """
+        log.debug('Listing repositories for %s in the background', key)
+        try:
+            self._set(key, self._dump(fetch(), dump))
+        except Exception:
+            log.warning('Failed to list repositories for %s', key,
+                        exc_info=True)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    @staticmethod
+    def _dump(repos, dump):
+        if dump is None:
+            return list(repos)
+        return [dump(repo) for repo in repos]
+
+    def _set(self, key, repos):
+        """
+        Stores the listing of an owner, replacing the cache file
+        atomically.
+        """
+        with self.lock:
+            self.entries[key] = {'time': time.time(), 'repos': repos}
+            self.refreshed.add(key)
+            if self.path is None:
+                return
+            state = {'version': CACHE_VERSION, 'entries': self.entries}
+            tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+            try:
+                cache_dir = os.path.dirname(self.path)
+                if cache_dir and not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                with open(tmp_path, 'w') as f:
+                    json.dump(state, f)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError):
+                # the cache is only an optimization
+                log.debug('Could not persist the repository cache in %s',
+                          self.path, exc_info=True)
+
+
+class CachedRepo(object):
+    """
+    A repository read from the cache, exposing its metadata as attributes
+    like the objects of the git service libraries do.
+    """
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+def configure(path=None, ttl=DEFAULT_TTL, refresh=False,
+              max_age=DEFAULT_MAX_AGE):
+    """
+    Enables the repository listing cache.
+    Args:
+        path (str): Path of the file used to persist the cache
+        ttl (int): Number of seconds a listing is used before it is listed
+                   again in the background
+        refresh (bool): List the repositories again on first use, whatever
+                        the age of the cached listings
+        max_age (int): Number of seconds after which a listing is listed
+                       again before being used
+    """
+    global cache
+    cache = RepoCache(path, ttl, refresh, max_age)
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+
+# Styles the report can be written in
+FORMATS = ('oneline', 'indented', 'json', 'ndjson')
+
+
+class ReportWriter(object):
+    """
+    Writes the reviews of a report one at a time, so that they can be
+    written as soon as they are known. JSON and NDJSON records are
+    compact and serialized by a single encoder.
+    """
+    def __init__(self, stream, style='oneline'):
+        if style not in FORMATS:
+            raise ValueError('Invalid format: %s' % style)
+        self.stream = stream
+        self.style = style
+        self.encoder = json.JSONEncoder(separators=(',', ':'))
+        self.count = 0
+        if style == 'json':
+            self.stream.write('[')
+
+    def write(self, review):
+        """
+        Writes a review.
+        Args:
+            review (BaseReview): review to write
+        """
+        if self.style == 'json':
+            if self.count:
+                self.stream.write(',\n')
+            self.stream.write(self.encoder.encode(review.__json__()))
+        elif self.style == 'ndjson':
+            self.stream.write(self.encoder.encode(review.__json__()))
+            self.stream.write('\n')
+        else:
+            self.stream.write(review.format(style=self.style, i=self.count,
+                                            N=None))
+            self.stream.write('\n')
+        self.count += 1
+
+    def close(self):
+        """
+        Ends the report, and flushes it.
+        """
+        if self.style == 'json':
+            self.stream.write(']\n')
+        self.stream.flush()
+
+
+class ReportOutput(object):
+    """
+    Context manager opening the file a report is written to, and replacing
+    it atomically once the report is complete. The report goes to the
+    standard output if no path is given.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.tmp_path = None
+        self.stream = None
+
+    def __enter__(self):
+        if self.path is None:
+            self.stream = sys.stdout
+        else:
+            self.tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+            self.stream = open(self.tmp_path, 'w')
+        return self.stream
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.path is None:
+            self.stream.flush()
+            return
+        self.stream.close()
+        if exc_type is None:
+            os.rename(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
@@ -0,0 +1,223 @@
+import bisect
+import gzip
+import hashlib
+import io
+import json
+import logging
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # python3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # python2
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+from email.utils import formatdate
+
+log = logging.getLogger(__name__)
+
+# Path the review data is served at
+DATA_PATH = '/data.json'
+
+# Filters accepted as query parameters
+FILTERS = ('service', 'repo', 'user', 'older_than', 'newer_than')
+
+# Maximum number of filtered payloads kept between two refreshes
+MAX_FILTERED = 256
+
+# Number of seconds in the units accepted by the age filters
+AGE_UNITS = {'': 1, 's': 1, 'min': 60, 'h': 3600, 'd': 86400}
+
+_age_pattern = re.compile(r'^(\d+)(min|h|d|s)?$')
+
+
+def parse_age(age):
+    """
+    Parses an age given as a number of seconds, minutes, hours or days,
+    e.g. 90, 30min, 12h or 2d.
+    Args:
+        age (str): age to parse
+    Returns:
+        seconds (int): age in seconds
+    Raises:
+        ValueError if the age is not valid
+    """
+    match = _age_pattern.match(age)
+    if match is None:
+        raise ValueError('Invalid age: %s' % age)
+    return int(match.group(1)) * AGE_UNITS[match.group(2) or '']
+
+
+class Payload(object):
+    """
+    A serialized JSON document, compressed once up front and identified by
+    an ETag.
+    """
+    def __init__(self, data, modified):
+        self.body = json.dumps(data).encode('utf-8')
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+            f.write(self.body)
+        self.gzipped = buf.getvalue()
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()
+        self.last_modified = formatdate(modified, usegmt=True)
+
+
+class ReviewData(object):
+    """
+    Holds the latest reviews in memory, along with indexes used to answer
+    filtered queries without going through all the reviews.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.update([])
+
+    def update(self, entries):
+        """
+        Replaces the reviews served.
+        Args:
+            entries (list): list of (service, repo, review) tuples, in the
+                            order the reviews should be served
+        """
+        modified = time.time()
+        records = []
+        indexes = {'service': {}, 'repo': {}, 'user': {}}
+        epochs = []
+        for position, (service, repo, review) in enumerate(entries):
+            records.append(review.__json__())
+            for name, value in (('service', service), ('repo', repo),
+                                ('user', review.user)):
+                indexes[name].setdefault(value, set()).add(position)
+            epochs.append((review.timestamp, position))
+        epochs.sort()
+
+        payload = Payload(records, modified)
+        with self.lock:
+            self.records = records
+            self.indexes = indexes
+            self.epochs = epochs
+            self.modified = modified
+            self.payload = payload
+            self.filtered = {}
+
+    def get(self, filters):
+        """
+        Returns the payload for the given filters.
+        Args:
+            filters (dict): filter name to value
+        Returns:
+            payload (Payload): serialized reviews matching all the filters
+        Raises:
+            ValueError if a filter is not valid
+        """
+        with self.lock:
+            if not filters:
+                return self.payload
+            key = tuple(sorted(filters.items()))
+            if key in self.filtered:
+                return self.filtered[key]
+            payload = Payload([self.records[position]
+                               for position in self._select(filters)],
+                              self.modified)
+            # age filters depend on the current time, so they can't be
+            # reused until the next refresh
+            if 'older_than' not in filters and 'newer_than' not in filters:
+                if len(self.filtered) >= MAX_FILTERED:
+                    self.filtered.clear()
+                self.filtered[key] = payload
+            return payload
+
+    def _select(self, filters):
+        """
+        Returns the positions of the reviews matching all the filters.
+        """
+        selected = None
+        for name in ('service', 'repo', 'user'):
+            if name in filters:
+                positions = self.indexes[name].get(filters[name], set())
+                selected = positions if selected is None \
+                    else selected & positions
+
+        now = time.time()
+        if 'older_than' in filters:
+            cutoff = now - parse_age(filters['older_than'])
+            end = bisect.bisect_right(self.epochs,
+                                      (cutoff, len(self.epochs)))
+            positions = set(position for _, position in self.epochs[:end])
+            selected = positions if selected is None \
+                else selected & positions
+        if 'newer_than' in filters:
+            cutoff = now - parse_age(filters['newer_than'])
+            start = bisect.bisect_right(self.epochs,
+                                        (cutoff, len(self.epochs)))
+            positions = set(position for _, position in self.epochs[start:])
+            selected = positions if selected is None \
+                else selected & positions
+
+        if selected is None:
+            return range(len(self.records))
+        return sorted(selected)
+
+
+class ReviewRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the review data held by the server as JSON.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in ('/', DATA_PATH):
+            self.send_error(404)
+            return
+
+        query = parse_qs(url.query)
+        filters = dict((name, query[name][-1])
+                       for name in FILTERS if name in query)
+        try:
+            payload = self.server.data.get(filters)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        if self.headers.get('If-None-Match') == payload.etag:
+            self.send_response(304)
+            self.send_header('ETag', payload.etag)
+            self.end_headers()
+            return
+
+        body = payload.body
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = payload.gzipped
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', payload.etag)
+        self.send_header('Last-Modified', payload.last_modified)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'Last-Modified')
+        self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s', self.address_string(), format % args)
+
+
+class ReviewServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server answering from the review data held in memory, so that
+    loading the dashboard never causes a request to the git services.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, data=None):
+        HTTPServer.__init__(self, address, ReviewRequestHandler)
+        self.data = data if data is not None else ReviewData()
@@ -0,0 +1,155 @@
+import heapq
+import logging
+import tempfile
+
+try:
+    import cPickle as pickle  # python2
+except ImportError:
+    import pickle  # python3
+
+log = logging.getLogger(__name__)
+
+# Default number of reviews kept in memory before spilling them to disk
+DEFAULT_SPILL_THRESHOLD = 100000
+
+
+class TopReviews(object):
+    """
+    Keeps the limit oldest reviews (or newest, if reverse), optionally per
+    group, e.g. per repository or per user, in bounded heaps. Reviews can
+    be added in any order: ties are broken by the order given with every
+    review, so that the result is the same as sorting all the reviews and
+    keeping the first ones.
+    """
+    def __init__(self, limit, reverse=False):
+        self.limit = limit
+        self.reverse = reverse
+        self.heaps = {}
+
+    def add(self, review, order, group=None):
+        """
+        Adds a review, dropping it right away if limit reviews of its group
+        come before it.
+        Args:
+            review (BaseReview): review to add
+            order (tuple): position of the review in the unsorted results,
+                           e.g. (request index, index in the response)
+            group (str): group the limit applies to, None for all reviews
+        """
+        timestamp = review.timestamp
+        key = (-timestamp if self.reverse else timestamp, order)
+        # heaps hold the negated keys, so that the last review to keep is
+        # on top
+        entry = (_Reversed(key), review)
+        heap = self.heaps.setdefault(group, [])
+        if len(heap) < self.limit:
+            heapq.heappush(heap, entry)
+        elif key < heap[0][0].key:
+            heapq.heapreplace(heap, entry)
+
+    def results(self):
+        """
+        Returns the kept reviews of all the groups, sorted.
+        Returns:
+            reviews (list): sorted reviews
+        """
+        entries = [entry for heap in self.heaps.values() for entry in heap]
+        entries.sort(key=lambda entry: entry[0].key)
+        return [review for _, review in entries]
+
+
+class SpillingSort(object):
+    """
+    Sorts reviews by creation date with bounded memory: once threshold
+    reviews are held in memory, they are sorted and written to a
+    temporary file, and the sorted files are merged back while the
+    reviews are read. Like TopReviews, ties are broken by the order given
+    with every review.
+    """
+    def __init__(self, threshold=DEFAULT_SPILL_THRESHOLD, reverse=False):
+        self.threshold = threshold
+        self.reverse = reverse
+        self.entries = []
+        self.runs = []
+
+    def add(self, review, order):
+        """
+        Adds a review.
+        Args:
+            review (BaseReview): review to add
+            order (tuple): position of the review in the unsorted results,
+                           e.g. (request index, index in the response)
+        """
+        timestamp = review.timestamp
+        self.entries.append(
+            (-timestamp if self.reverse else timestamp, order, review))
+        if len(self.entries) >= self.threshold:
+            self._spill()
+
+    def _spill(self):
+        """
+        Writes the reviews held in memory to a temporary file, sorted.
+        """
+        self.entries.sort(key=_entry_key)
+        run = tempfile.TemporaryFile()
+        # entries are pickled one by one, so that reading them back never
+        # keeps the previous ones referenced
+        for entry in self.entries:
+            pickle.dump(entry, run, pickle.HIGHEST_PROTOCOL)
+        run.flush()
+        self.runs.append(run)
+        log.debug('Spilled %s reviews to disk', len(self.entries))
+        self.entries = []
+
+    def results(self):
+        """
+        Returns the reviews, sorted.
+        Returns:
+            generator yielding the sorted reviews
+        """
+        self.entries.sort(key=_entry_key)
+        if not self.runs:
+            entries = self.entries
+        else:
+            entries = heapq.merge(self.entries,
+                                  *[_read_run(run) for run in self.runs])
+        try:
+            for _, _, review in entries:
+                yield review
+        finally:
+            for run in self.runs:
+                run.close()
+            self.runs = []
+            self.entries = []
+
+
+def _entry_key(entry):
+    return entry[:2]
+
+
+def _read_run(run):
+    """
+    Reads back the entries of a temporary file written by _spill.
+    """
+    run.seek(0)
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+
+class _Reversed(object):
+    """
+    Wraps a key to reverse its order in a heap.
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
@@ -0,0 +1,105 @@
+import heapq
+import logging
+import random
+import time
+
+log = logging.getLogger(__name__)
+
+# Default number of seconds between two refreshes of a git service entry
+DEFAULT_INTERVAL = 300
+
+# Default fraction of the interval by which refreshes are randomly shifted
+DEFAULT_JITTER = 0.1
+
+
+class Scheduler(object):
+    """
+    Schedules the refresh of every git service entry on its own interval.
+    Every entry is due right away, and then every interval seconds,
+    randomly shifted by up to jitter * interval so that the entries of a
+    host are not refreshed in bursts.
+    """
+    def __init__(self, intervals, jitter=DEFAULT_JITTER,
+                 clock=time.time, sleep=time.sleep):
+        self.intervals = intervals
+        self.jitter = jitter
+        self.clock = clock
+        self.sleep = sleep
+        now = clock()
+        self.queue = [(now, index) for index in range(len(intervals))]
+        heapq.heapify(self.queue)
+
+    def next_run(self, index, now):
+        """
+        Returns the time of the next refresh of an entry.
+        Args:
+            index (int): index of the entry
+            now (float): time of the current refresh
+        Returns:
+            next_run (float): time of the next refresh
+        """
+        interval = self.intervals[index]
+        shift = random.uniform(-self.jitter, self.jitter) * interval
+        return now + interval + shift
+
+    def wait(self):
+        """
+        Sleeps until at least one entry is due.
+        Returns:
+            due (list): indices of the entries to refresh now, which are
+                        scheduled again
+        """
+        if not self.queue:
+            return []
+        delay = self.queue[0][0] - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+        now = self.clock()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            _, index = heapq.heappop(self.queue)
+            due.append(index)
+        for index in due:
+            heapq.heappush(self.queue, (self.next_run(index, now), index))
+        return sorted(due)
+
+
+def refresh(due, items, responses, iter_responses):
+    """
+    Refreshes the responses of the due entries, requesting the reviews of
+    all of them at once. An entry with a failing request keeps the
+    responses of its last refresh, while the others are updated.
+    Args:
+        due (list): indices of the entries to refresh
+        items (list): review requests of every entry
+        responses (list): responses of every entry, updated in place
+        iter_responses (callable): function requesting the reviews of a
+                                   list of review requests, yielding
+                                   (index, response) tuples where the
+                                   response of a failing request is the
+                                   exception it raised
+    Returns:
+        failed (list): indices of the entries which failed to refresh
+    """
+    review_requests = []
+    owners = []
+    for index in due:
+        review_requests.extend(items[index])
+        owners.extend([index] * len(items[index]))
+
+    due_responses = dict((index, []) for index in due)
+    for position, response in iter_responses(review_requests):
+        due_responses[owners[position]].append((position, response))
+
+    failed = []
+    for index in due:
+        item_responses = [response for _, response
+                          in sorted(due_responses[index],
+                                    key=lambda result: result[0])]
+        if any(isinstance(response, Exception)
+               for response in item_responses):
+            log.error('Failed to refresh config item %s', index)
+            failed.append(index)
+        else:
+            responses[index] = item_responses
+    return failed
@@ -1,6 +1,8 @@
 import logging
 
 import argparse
+import io
+import json
 import os
 
 import mock
@@ -12,11 +14,34 @@ from unittest import TestCase
 from reviewrot.githubstack import GithubService
 from reviewrot.gitlabstack import GitlabService
 from reviewrot.pagurestack import PagureService
-from reviewrot.gerritstack import GerritService
+from reviewrot.gerritstack import GerritService, ValidationCache
 from reviewrot import get_git_service, get_arguments, load_config_file
+from reviewrot import iter_requests
 from github.GithubException import BadCredentialsException
 from gitlab.exceptions import GitlabConnectionError
 import reviewrot
+import shutil
+import tempfile
+import threading
+import time
+from reviewrot.httpcache import CachingAdapter, HTTPCache
+from reviewrot.incremental import ReviewState
+from reviewrot import repocache
+from reviewrot.repocache import RepoCache
+from reviewrot import ratelimit
+from reviewrot.ratelimit import RateLimit, RateLimitAdapter, retry_delay
+from reviewrot.githubstack import GithubReview
+from reviewrot.watch import Scheduler, refresh
+from reviewrot.server import ReviewData
+from reviewrot.report import ReportOutput, ReportWriter
+from reviewrot.columns import ReviewColumns
+from reviewrot.sorting import SpillingSort, TopReviews
+from reviewrot.basereview import AgeFilter, BaseReview, BaseService
+from reviewrot.basereview import map_repos, reset_reference_time
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.models import PreparedRequest, Response
+from datetime import datetime, timedelta
 
 # Disable logging to avoid messing up test output
 logging.disable(logging.CRITICAL)
@@ -31,6 +56,17 @@ class GithubTest(TestCase):
     def test_object_create(self):
         self.assertTrue(isinstance((get_git_service('github')), GithubService))
 
+    def test_object_shared_per_host_and_token(self):
+        service = get_git_service('github', token=self.config['token'])
+        self.assertTrue(service is get_git_service(
+            'github', token=self.config['token']))
+        self.assertFalse(service is get_git_service('github', token='other'))
+
+    def test_client_reused(self):
+        github = GithubService()
+        self.assertTrue(github.get_client(self.config['token']) is
+                        github.get_client(self.config['token']))
+
     def test_request_review_token(self):
         github = GithubService()
         with self.assertRaises(BadCredentialsException) as context:
@@ -84,6 +120,98 @@ class GithubTest(TestCase):
                                           repo_name=self.config['repo_name'])
         self.assertEqual(res, [])
 
+    def test_get_reviews_stops_at_age_bound(self):
+        now = datetime.utcnow()
+        pulls = [mock.Mock(created_at=now - timedelta(hours=hours),
+                           updated_at=now,
+                           html_url='url %s' % hours)
+                 for hours in (1, 60, 100)]
+        # listing stops before going through the oldest pull request
+        type(pulls[-1]).title = mock.PropertyMock(
+            side_effect=AssertionError('listing did not stop'))
+        repo = mock.Mock(**{'get_pulls.return_value': pulls})
+        uname = mock.Mock(**{'get_repo.return_value': repo})
+        res = GithubService().get_reviews(uname=uname, repo_name='repo',
+                                          state_='newer', value=2,
+                                          duration='d')
+        repo.get_pulls.assert_called_once_with(sort='created',
+                                               direction='desc')
+        self.assertEqual(['url 1'], [review.url for review in res])
+
+    def test_request_reviews_graphql(self):
+        def pull(number, comments):
+            return {'title': 'title %s' % number,
+                    'url': 'url %s' % number,
+                    'createdAt': '2018-01-0%sT00:00:00Z' % number,
+                    'updatedAt': '2018-02-01T00:00:00Z',
+                    'author': {'login': 'user', 'avatarUrl': 'avatar'},
+                    'reviews': {'nodes': [{'comments': {'totalCount': c}}
+                                          for c in comments]}}
+
+        def page(nodes, cursor=None):
+            return {'pageInfo': {'hasNextPage': cursor is not None,
+                                 'endCursor': cursor},
+                    'nodes': nodes}
+
+        owner = {'data': {'repositoryOwner': {'repositories': page([
+            {'name': 'repo1', 'isArchived': False,
+             'pullRequests': page([pull(3, [2, 1])], 'c')},
+            {'name': 'repo2', 'isArchived': False,
+             'pullRequests': page([])},
+            {'name': 'repo3', 'isArchived': True,
+             'pullRequests': page([pull(4, [])], 'd')},
+        ])}}}
+        repo = {'data': {'repository': {'pullRequests': page([
+            pull(2, []), dict(pull(1, [4]), author=None)])}}}
+        github = GithubService()
+        with mock.patch.object(github, '_call_api',
+                               side_effect=[owner, repo]) as call_api:
+            res = github.request_reviews(user_name='org', token='token',
+                                         graphql=True)
+        self.assertEqual(
+            [('user', 'url 3', 3), ('user', 'url 2', 0), ('ghost', 'url 1', 4)],
+            [(review.user, review.url, review.comments) for review in res])
+        self.assertEqual(datetime(2018, 1, 3), res[0].time)
+        self.assertEqual(2, call_api.call_count)
+        args, kwargs = call_api.call_args
+        self.assertEqual(('https://api.github.com/graphql',), args)
+        self.assertEqual('POST', kwargs['method'])
+        self.assertEqual({'owner': 'org', 'name': 'repo1', 'cursor': 'c',
+                          'direction': 'DESC'},
+                         kwargs['data']['variables'])
+        self.assertEqual({'Authorization': 'bearer token'}, github.header)
+
+    def test_select_repo(self):
+        def repo(name='repo', archived=False, open_issues_count=1):
+            repo = mock.Mock(archived=archived,
+                             open_issues_count=open_issues_count)
+            repo.name = name
+            return repo
+
+        self.assertTrue(GithubService.select_repo(repo()))
+        self.assertFalse(GithubService.select_repo(repo(archived=True)))
+        self.assertFalse(GithubService.select_repo(
+            repo(open_issues_count=0)))
+        # closed pull requests are still listed in incremental mode
+        self.assertTrue(GithubService.select_repo(
+            repo(open_issues_count=0), since=datetime.utcnow()))
+        self.assertTrue(GithubService.select_repo(
+            repo('review-rot'), include=['review-*'], exclude=['*-old']))
+        self.assertFalse(GithubService.select_repo(
+            repo('review-old'), include=['review-*'], exclude=['*-old']))
+        self.assertFalse(GithubService.select_repo(
+            repo('other'), include=['review-*']))
+
+    def test_request_reviews_graphql_errors(self):
+        github = GithubService()
+        response = {'data': None,
+                    'errors': [{'message': 'Bad credentials'}]}
+        with mock.patch.object(github, '_call_api', return_value=response):
+            with self.assertRaises(Exception) as context:
+                github.request_reviews(user_name='org', repo_name='repo',
+                                       token='token', graphql=True)
+        self.assertTrue('Bad credentials' in str(context.exception))
+
 
 class GitlabTest(TestCase):
     def setUp(self):
@@ -136,6 +264,67 @@ class GitlabTest(TestCase):
                                               host=self.config['host'])
         self.assertEqual([self.config['msg']], res)
 
+    def test_get_group_reviews(self):
+        mr = mock.Mock(author={'username': 'user'}, title='title',
+                       web_url='https://gitlab.com/group/project/'
+                               'merge_requests/1',
+                       created_at='2017-11-08T09:00:00.000Z',
+                       updated_at='2017-11-08T09:00:00.000Z',
+                       state='opened', user_notes_count=2)
+        group = mock.Mock()
+        group.mergerequests.list.return_value = [mr]
+        res = GitlabService().get_group_reviews(uname='group', group=group)
+        group.mergerequests.list.assert_called_once_with(state='opened',
+                                                         per_page=100,
+                                                         as_list=False)
+        self.assertEqual(1, len(res))
+        self.assertEqual(mr.web_url, res[0].url)
+        self.assertEqual(2, res[0].comments)
+
+    def test_get_group_reviews_selects_projects(self):
+        mrs = [mock.Mock(author={'username': 'user'}, title='title',
+                         web_url='url %s' % project_id,
+                         created_at='2017-11-08T09:00:00.000Z',
+                         updated_at='2017-11-08T09:00:00.000Z',
+                         state='opened', user_notes_count=0,
+                         project_id=project_id)
+               for project_id in (1, 2)]
+        projects = [mock.Mock(id=1, path='review-rot'),
+                    mock.Mock(id=2, path='other')]
+        group = mock.Mock()
+        group.mergerequests.list.return_value = mrs
+        group.projects.list.return_value = projects
+        res = GitlabService().get_group_reviews(uname='group', group=group,
+                                                include=['review-*'])
+        self.assertEqual(['url 1'], [review.url for review in res])
+
+    def test_select_project(self):
+        service = GitlabService()
+        created_after = datetime(2018, 1, 1)
+
+        def project(**kwargs):
+            kwargs.setdefault('path', 'project')
+            kwargs.setdefault('last_activity_at', '2018-01-02T00:00:00Z')
+            return mock.Mock(spec=list(kwargs), **kwargs)
+
+        self.assertTrue(service.select_project(project(), None,
+                                               created_after))
+        self.assertFalse(service.select_project(project(archived=True)))
+        self.assertFalse(service.select_project(project(empty_repo=True)))
+        self.assertFalse(service.select_project(
+            project(merge_requests_enabled=False)))
+        inactive = project(last_activity_at='2017-12-01T00:00:00.000Z')
+        self.assertFalse(service.select_project(inactive, None,
+                                                created_after))
+        self.assertTrue(service.select_project(inactive))
+        self.assertFalse(service.select_project(project(), exclude=['p*']))
+
+    def test_filters_bound_creation_date(self):
+        filters = GitlabService()._filters('older', 3, 'd', None)
+        self.assertEqual(['created_before', 'state'], sorted(filters))
+        filters = GitlabService()._filters('newer', 3, 'd', None)
+        self.assertEqual(['created_after', 'state'], sorted(filters))
+
 
 class PagureTest(TestCase):
     def setUp(self):
@@ -160,6 +349,14 @@ class PagureTest(TestCase):
                                    repo_name=self.config['repo_name'])
         self.assertIn('Page not found', str(context.exception))
 
+    @mock.patch('reviewrot.pagurestack.PagureService._call_api',
+                side_effect=[{'requests': [1], 'pagination': {'next': 'p2'}},
+                             {'requests': [2], 'pagination': {'next': None}}])
+    def test_get_pull_requests_all_pages(self, mock_call_api):
+        pages = PagureService().get_pull_requests('pull-requests', True)
+        self.assertEqual([[1], [2]], list(pages))
+        self.assertEqual(2, mock_call_api.call_count)
+
 
 class GerritTest(TestCase):
     def setUp(self):
@@ -194,6 +391,751 @@ class GerritTest(TestCase):
                                         host=self.config['host'])
         self.assertTrue(result is not None)
 
+    @mock.patch('reviewrot.gerritstack.GerritService.get_comments_count',
+                return_value=3)
+    def test_gerrit_comments_counts(self, mock_get_comments_count):
+        changes = [{'id': 'change1', 'total_comment_count': 5},
+                   {'id': 'change2'}, {'id': 'change3'}]
+        res = GerritService().get_comments_counts(changes)
+        self.assertEqual({'change1': 5, 'change2': 3, 'change3': 3}, res)
+        self.assertEqual(2, mock_get_comments_count.call_count)
+
+    @mock.patch('reviewrot.gerritstack.GerritService._call_api',
+                side_effect=[[{'id': 1, '_more_changes': True}],
+                             [{'id': 2}]])
+    def test_gerrit_get_changes_all_pages(self, mock_call_api):
+        pages = GerritService().get_changes('changes/?q=project:gerrit', True)
+        self.assertEqual([[{'id': 1, '_more_changes': True}], [{'id': 2}]],
+                         list(pages))
+        self.assertTrue(mock_call_api.call_args[1]['url'].endswith('S=1'))
+
+    def test_gerrit_shared_service_per_host(self):
+        self.assertTrue(get_git_service('gerrit', self.config['host']) is
+                        get_git_service('gerrit', self.config['host']))
+
+    @mock.patch('reviewrot.gerritstack.GerritService._call_api',
+                return_value=[])
+    @mock.patch('reviewrot.gerritstack.GerritService.check_repo_exists')
+    @mock.patch('reviewrot.gerritstack.GerritService.check_host_url')
+    def test_gerrit_validation_is_cached(self, mock_check_host_url,
+                                         mock_check_repo_exists,
+                                         mock_call_api):
+        gerrit = GerritService()
+        for _ in range(3):
+            gerrit.request_reviews(repo_name='cached_repo',
+                                   host='https://cached.example.com')
+        self.assertEqual(1, mock_check_host_url.call_count)
+        self.assertEqual(1, mock_check_repo_exists.call_count)
+
+    def test_gerrit_validation_cache_persisted(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = join(tmp_dir, 'cache', 'gerrit.json')
+        ValidationCache(path).add('https://example.com')
+        self.assertTrue('https://example.com' in ValidationCache(path))
+
+        # failing to persist it only loses it for the next runs
+        open(join(tmp_dir, 'file'), 'w').close()
+        cache = ValidationCache(join(tmp_dir, 'file', 'gerrit.json'))
+        cache.add('https://example.com')
+        self.assertTrue('https://example.com' in cache)
+
+
+class IterRequestsTest(TestCase):
+    class FakeService(object):
+        def request_reviews(self, user_name, **kwargs):
+            return [user_name + '-1', user_name + '-2']
+
+    def setUp(self):
+        service = self.FakeService()
+        self.review_requests = [(service, {'user_name': name})
+                                for name in ('a', 'b', 'c', 'd')]
+        self.expected = ['a-1', 'a-2', 'b-1', 'b-2',
+                         'c-1', 'c-2', 'd-1', 'd-2']
+
+    def reviews(self, jobs=None):
+        responses = dict(iter_requests(self.review_requests, jobs=jobs))
+        return [review for index in sorted(responses)
+                for review in responses[index]]
+
+    def test_iter_requests_serial(self):
+        self.assertEqual(self.expected, self.reviews())
+
+    def test_iter_requests_concurrent(self):
+        self.assertEqual(self.expected, self.reviews(jobs=3))
+
+    def test_iter_requests_indexes_responses(self):
+        res = dict(iter_requests(self.review_requests, jobs=3))
+        self.assertEqual(['a-1', 'a-2'], res[0])
+        self.assertEqual(['d-1', 'd-2'], res[3])
+
+
+def http_response(status_code, headers, body=b''):
+    res = Response()
+    res.status_code = status_code
+    res.headers.update(headers)
+    res.encoding = 'utf-8'
+    res._content = body
+    res.raw = io.BytesIO(b'')
+    return res
+
+
+class HTTPCacheTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _response(self, body):
+        return mock.Mock(headers={'ETag': '"v1"', 'Content-Length': '3'},
+                         encoding='utf-8', content=body)
+
+    def test_set_and_get(self):
+        cache = HTTPCache(self.path)
+        cache.set('key', self._response(b'abc'))
+        meta, body = cache.get('key')
+        self.assertEqual(b'abc', body)
+        self.assertEqual({'ETag': '"v1"'}, meta['headers'])
+
+    def test_expired_entry(self):
+        cache = HTTPCache(self.path, ttl=-1)
+        cache.set('key', self._response(b'abc'))
+        self.assertTrue(cache.get('key') is None)
+
+    def test_lru_eviction(self):
+        cache = HTTPCache(self.path)
+        cache.max_size = 1
+        cache.set('key', self._response(b'abc'))
+        self.assertTrue(cache.get('key') is None)
+
+    def test_unwritable_cache_ignored(self):
+        open(join(self.path, 'file'), 'w').close()
+        cache = HTTPCache(join(self.path, 'file', 'cache'))
+        cache.set('key', self._response(b'abc'))
+        self.assertTrue(cache.get('key') is None)
+
+    def test_github_request_revalidated(self):
+        session = Session()
+        session.mount('https://', CachingAdapter(HTTPCache(self.path)))
+        body = json.dumps({'name': 'repo'}).encode('utf-8')
+        responses = [http_response(200, {'ETag': '"v1"'}, body),
+                     http_response(304, {'ETag': '"v1"'})]
+        g = GithubService().get_client('revalidated')
+        with mock.patch('reviewrot.githubstack.get_session',
+                        return_value=session), \
+                mock.patch.object(HTTPAdapter, 'send',
+                                  side_effect=responses) as send:
+            for _ in range(2):
+                self.assertEqual('repo', g.get_repo('owner/repo').name)
+        # the second request is answered from the cache, with a 304 which
+        # github doesn't count against the rate limit
+        self.assertEqual('"v1"',
+                         send.call_args[0][0].headers['If-None-Match'])
+
+
+class ReviewStateTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.state_file = join(self.path, 'state.json')
+        self.key = ReviewState.key('github', None, 'user', 'repo')
+        self.created = datetime(2017, 1, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _review(self, url, days, closed=False):
+        return GithubReview(user='user', title='title', url=url,
+                            time=self.created, comments=0, image='image',
+                            updated=self.created + timedelta(days=days),
+                            closed=closed)
+
+    def test_full_refresh_then_incremental(self):
+        state = ReviewState(self.state_file)
+        state.update(self.key, [self._review('pr1', 1),
+                                self._review('pr2', 2)], incremental=False)
+        state.save()
+
+        state = ReviewState(self.state_file)
+        self.assertEqual(self.created + timedelta(days=2),
+                         state.since(self.key))
+        res = state.update(self.key, [self._review('pr1', 3, closed=True),
+                                      self._review('pr3', 4)],
+                           incremental=True)
+        self.assertEqual(['pr2', 'pr3'], [review.url for review in res])
+        self.assertTrue(isinstance(res[0], GithubReview))
+        self.assertEqual(self.created + timedelta(days=4),
+                         state.since(self.key))
+
+
+class SchedulerTest(TestCase):
+    def setUp(self):
+        self.now = 0
+
+    def _clock(self):
+        return self.now
+
+    def _sleep(self, seconds):
+        self.now += seconds
+
+    def test_every_entry_due_at_start(self):
+        scheduler = Scheduler([10, 60], clock=self._clock, sleep=self._sleep)
+        self.assertEqual([0, 1], scheduler.wait())
+
+    def test_entries_refreshed_on_their_interval(self):
+        scheduler = Scheduler([10, 60], jitter=0,
+                              clock=self._clock, sleep=self._sleep)
+        scheduler.wait()
+        due = []
+        for _ in range(6):
+            entries = scheduler.wait()
+            due.append((self.now, entries))
+        self.assertEqual([(10, [0]), (20, [0]), (30, [0]), (40, [0]),
+                          (50, [0]), (60, [0, 1])], due)
+
+    class FakeService(object):
+        def __init__(self, started=None, expected=1):
+            self.lock = threading.Lock()
+            self.calls = 0
+            self.started = started
+            self.expected = expected
+            self.concurrent = []
+
+        def request_reviews(self, user_name, **kwargs):
+            if user_name == 'down':
+                raise IOError('service down')
+            if self.started is not None:
+                with self.lock:
+                    self.calls += 1
+                    if self.calls == self.expected:
+                        self.started.set()
+                # every request is waited for by the others
+                self.concurrent.append(self.started.wait(5))
+            return [user_name + '-new']
+
+    def test_failed_entry_keeps_last_responses(self):
+        service = self.FakeService()
+        items = [[(service, {'user_name': 'a'})],
+                 [(service, {'user_name': 'b'}),
+                  (service, {'user_name': 'down'})],
+                 [(service, {'user_name': 'c'})]]
+        responses = [['a-old'], ['b-old'], ['c-old']]
+
+        self.assertEqual([1], refresh(
+            [0, 1, 2], items, responses,
+            lambda review_requests: iter_requests(review_requests, jobs=3,
+                                                  isolate=True)))
+        self.assertEqual([[['a-new']], ['b-old'], [['c-new']]], responses)
+
+    def test_due_entries_requested_concurrently(self):
+        service = self.FakeService(threading.Event(), expected=2)
+        items = [[(service, {'user_name': 'a'})],
+                 [(service, {'user_name': 'b'})]]
+        responses = [[], []]
+
+        self.assertEqual([], refresh(
+            [0, 1], items, responses,
+            lambda review_requests: iter_requests(review_requests, jobs=2,
+                                                  isolate=True)))
+        self.assertEqual([[['a-new']], [['b-new']]], responses)
+        self.assertEqual([True, True], service.concurrent)
+
+
+class ReviewDataTest(TestCase):
+    def setUp(self):
+        now = datetime.utcnow()
+        self.data = ReviewData()
+        self.data.update([
+            ('github', 'user/repo',
+             GithubReview(user='user1', title='title', url='old',
+                          time=now - timedelta(days=3), comments=0,
+                          image='image')),
+            ('gitlab', 'group/project',
+             GithubReview(user='user2', title='title', url='new',
+                          time=now - timedelta(hours=1), comments=0,
+                          image='image')),
+        ])
+
+    def _urls(self, filters):
+        payload = self.data.get(filters)
+        return [review['url'] for review in json.loads(
+            payload.body.decode('utf-8'))]
+
+    def test_no_filters(self):
+        self.assertEqual(['old', 'new'], self._urls({}))
+
+    def test_index_filters(self):
+        self.assertEqual(['new'], self._urls({'service': 'gitlab'}))
+        self.assertEqual(['old'], self._urls({'repo': 'user/repo'}))
+        self.assertEqual([], self._urls({'user': 'user1',
+                                         'service': 'gitlab'}))
+
+    def test_age_filters(self):
+        self.assertEqual(['old'], self._urls({'older_than': '2d'}))
+        self.assertEqual(['new'], self._urls({'newer_than': '2h'}))
+
+    def test_invalid_age(self):
+        self.assertRaises(ValueError, self.data.get, {'older_than': 'old'})
+
+
+class MapReposTest(TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def request(self, repo):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        # later repositories complete first
+        time.sleep(0.01 * (5 - repo % 5))
+        with self.lock:
+            self.active -= 1
+        return [repo]
+
+    def test_serial(self):
+        self.assertEqual([[0], [1], [2]],
+                         list(map_repos(self.request, range(3))))
+        self.assertEqual(1, self.max_active)
+
+    def test_results_in_order(self):
+        res = list(map_repos(self.request, range(10), max_concurrency=3,
+                             host='order.example.com'))
+        self.assertEqual([[repo] for repo in range(10)], res)
+        self.assertEqual(3, self.max_active)
+
+    def test_cap_shared_by_host(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(list(
+            map_repos(self.request, range(6), max_concurrency=2,
+                      host='shared.example.com'))))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, len(results))
+        self.assertEqual(2, self.max_active)
+
+    def test_cap_per_limit(self):
+        list(map_repos(self.request, range(5), max_concurrency=2,
+                       host='limit.example.com'))
+        self.assertEqual(2, self.max_active)
+        # the limit of the first entry of the host doesn't apply
+        list(map_repos(self.request, range(5), max_concurrency=4,
+                       host='limit.example.com'))
+        self.assertEqual(4, self.max_active)
+
+    def test_error_raised(self):
+        def request(repo):
+            if repo == 1:
+                raise ValueError('repo %s' % repo)
+            return [repo]
+
+        with self.assertRaises(ValueError):
+            list(map_repos(request, range(5), max_concurrency=2,
+                           host='error.example.com'))
+
+
+class AgeFilterTest(TestCase):
+    def test_days(self):
+        now = datetime(2018, 3, 10, 12)
+        age_filter = AgeFilter('older', 2, 'd', now)
+        self.assertTrue(age_filter.accepts(datetime(2018, 3, 8, 12)))
+        self.assertFalse(age_filter.accepts(datetime(2018, 3, 8, 13)))
+        age_filter = AgeFilter('newer', 2, 'd', now)
+        self.assertFalse(age_filter.accepts(datetime(2018, 3, 8, 12)))
+        self.assertTrue(age_filter.accepts(datetime(2018, 3, 8, 13)))
+
+    def test_months_at_end_of_month(self):
+        # relativedelta counts a month between Feb 28th and Mar 31st
+        age_filter = AgeFilter('older', 1, 'm', datetime(2018, 3, 31, 12))
+        self.assertTrue(age_filter.accepts(datetime(2018, 2, 28, 18)))
+        self.assertFalse(age_filter.accepts(datetime(2018, 3, 1)))
+        # and between Jan 31st and Feb 28th, up to the time of day
+        age_filter = AgeFilter('older', 1, 'm', datetime(2018, 2, 28, 12))
+        self.assertTrue(age_filter.accepts(datetime(2018, 1, 31, 11)))
+        self.assertFalse(age_filter.accepts(datetime(2018, 1, 31, 13)))
+
+    def test_accepts_epochs(self):
+        age_filter = AgeFilter('newer', 1, 'h', datetime(1970, 1, 1, 2))
+        self.assertEqual([False, False, True],
+                         age_filter.accepts_epochs([0, 3600, 3601]))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            AgeFilter('younger', 1, 'd', datetime.utcnow())
+        with self.assertRaises(ValueError):
+            AgeFilter('older', 1, 'w', datetime.utcnow())
+
+    def test_shared_reference_time(self):
+        reset_reference_time(datetime(2018, 3, 10))
+        try:
+            service = BaseService()
+            self.assertTrue(service.check_request_state(
+                datetime(2018, 3, 9, 1), 'newer', 1, 'd'))
+            reset_reference_time(datetime(2018, 3, 11))
+            self.assertFalse(service.check_request_state(
+                datetime(2018, 3, 9, 1), 'newer', 1, 'd'))
+        finally:
+            reset_reference_time()
+
+
+class BaseReviewTest(TestCase):
+    def tearDown(self):
+        reset_reference_time()
+
+    def test_format_duration(self):
+        now = datetime(2018, 3, 31, 12)
+        self.assertEqual('2 days 1 hour 1 minute', BaseReview.format_duration(
+            datetime(2018, 3, 29, 10, 59), now))
+        self.assertEqual('1 month 3 days', BaseReview.format_duration(
+            datetime(2018, 2, 28, 12), now))
+
+    def test_since_follows_reference_time(self):
+        review = BaseReview(time=datetime(2018, 3, 29, 12))
+        reset_reference_time(datetime(2018, 3, 31, 12))
+        self.assertEqual('2 days', review.since)
+        reset_reference_time(datetime(2018, 4, 1, 12))
+        self.assertEqual('3 days', review.since)
+
+    def test_user_names_shared(self):
+        reviews = [BaseReview(user=''.join(['some', 'user']))
+                   for _ in range(2)]
+        self.assertTrue(reviews[0].user is reviews[1].user)
+        self.assertEqual(None, BaseReview().user)
+
+
+class ReviewColumnsTest(TestCase):
+    def setUp(self):
+        self.reviews = [GithubReview(user='user', title=str(day), url=str(day),
+                                     time=datetime(2018, 3, day), comments=0)
+                        for day in (3, 1, 2)]
+
+    def test_review_record(self):
+        review = self.reviews[0]
+        self.assertFalse(hasattr(review, '__dict__'))
+        self.assertEqual(datetime(2018, 3, 3), review.time)
+        self.assertTrue(review.user is self.reviews[1].user)
+
+    def test_sorted_and_filtered(self):
+        columns = ReviewColumns(self.reviews)
+        self.assertEqual(['1', '2', '3'],
+                         [review.url for review in columns.sorted()])
+        age_filter = AgeFilter('older', 2, 'd', datetime(2018, 3, 4))
+        filtered = columns.filter(age_filter)
+        self.assertEqual(['1', '2'], filtered.urls)
+        self.assertTrue(isinstance(list(filtered)[0], GithubReview))
+        self.assertEqual(datetime(2018, 3, 1), list(filtered)[0].time)
+
+    def test_review_dates_and_state_kept(self):
+        self.reviews[0].updated = datetime(2018, 3, 5)
+        self.reviews[0].closed = True
+        reviews = list(ReviewColumns(self.reviews).sorted(reverse=True))
+        self.assertEqual(datetime(2018, 3, 5), reviews[0].updated)
+        self.assertTrue(reviews[0].closed)
+        self.assertEqual(None, reviews[1].updated)
+        self.assertFalse(reviews[1].closed)
+
+
+class TopReviewsTest(TestCase):
+    def setUp(self):
+        self.reviews = [BaseReview(user=user, url='%s%s' % (user, day),
+                                   time=datetime(2018, 3, day))
+                        for user, day in (('a', 3), ('b', 1), ('a', 1),
+                                          ('b', 4), ('a', 2))]
+
+    def top(self, limit, reverse=False, per_user=False):
+        top = TopReviews(limit, reverse=reverse)
+        # add the reviews in a different order than their positions
+        for position, review in reversed(list(enumerate(self.reviews))):
+            top.add(review, (0, position), review.user if per_user else None)
+        return [review.url for review in top.results()]
+
+    def test_same_as_sorting(self):
+        for reverse in (False, True):
+            expected = [review.url for review in sorted(
+                self.reviews, key=lambda review: review.timestamp,
+                reverse=reverse)]
+            self.assertEqual(expected[:3], self.top(3, reverse))
+
+    def test_per_group(self):
+        self.assertEqual(['b1', 'a1'], self.top(1, per_user=True))
+        self.assertEqual(['b4', 'a3'],
+                         self.top(1, reverse=True, per_user=True))
+
+
+class SpillingSortTest(TestCase):
+    def test_same_as_sorting(self):
+        reviews = [GithubReview(user='user', url=str(position),
+                                time=datetime(2018, 3, 1 + position % 7))
+                   for position in range(20)]
+        for reverse in (False, True):
+            expected = [review.url for review in sorted(
+                reviews, key=lambda review: review.timestamp,
+                reverse=reverse)]
+            sorter = SpillingSort(threshold=3, reverse=reverse)
+            for position, review in enumerate(reviews):
+                sorter.add(review, (0, position))
+            self.assertEqual(6, len(sorter.runs))
+            self.assertEqual(expected,
+                             [review.url for review in sorter.results()])
+
+
+class ReportWriterTest(TestCase):
+    def setUp(self):
+        self.reviews = [BaseReview(user=name, title='title', url='url',
+                                   time=datetime(2018, 3, 1), comments=0)
+                        for name in ('a', 'b')]
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, style, reviews):
+        path = join(self.tmp_dir, 'report')
+        with ReportOutput(path) as stream:
+            writer = ReportWriter(stream, style)
+            for review in reviews:
+                writer.write(review)
+            writer.close()
+        with open(path) as f:
+            return f.read()
+
+    def test_json(self):
+        data = json.loads(self.write('json', self.reviews))
+        self.assertEqual(['a', 'b'], [review['user'] for review in data])
+        self.assertEqual([], json.loads(self.write('json', [])))
+
+    def test_ndjson(self):
+        lines = self.write('ndjson', self.reviews).splitlines()
+        self.assertEqual(['a', 'b'],
+                         [json.loads(line)['user'] for line in lines])
+
+    def test_output_kept_on_error(self):
+        path = join(self.tmp_dir, 'report')
+        self.write('oneline', self.reviews)
+        with self.assertRaises(RuntimeError):
+            with ReportOutput(path) as stream:
+                stream.write('partial')
+                raise RuntimeError()
+        with open(path) as f:
+            self.assertTrue(f.read().startswith('@a filed'))
+        self.assertEqual(['report'], os.listdir(self.tmp_dir))
+
+
+class ConfigCacheTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config_path = join(self.tmp_dir, 'config.yaml')
+        with open(self.config_path, 'w') as f:
+            f.write('git_services:\n- type: github\n  repos: [a/b]\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        reviewrot._configs.clear()
+
+    def test_cached_until_modified(self):
+        config = load_config_file(self.config_path)
+        self.assertEqual(['a/b'], config['git_services'][0]['repos'])
+        with mock.patch('yaml.load') as mocked_load:
+            self.assertTrue(config is load_config_file(self.config_path))
+            self.assertFalse(mocked_load.called)
+
+        with open(self.config_path, 'a') as f:
+            f.write('arguments: {format: json}\n')
+        config = load_config_file(self.config_path)
+        self.assertEqual('json', config['arguments']['format'])
+
+
+class RepoCacheTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = join(self.tmp_dir, 'repos.json')
+        self.key = RepoCache.key('github', None, 'org')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        repocache.cache = None
+
+    def wait_refreshed(self, cache):
+        for _ in range(100):
+            with cache.lock:
+                if not cache.refreshing:
+                    return
+            time.sleep(0.01)
+        self.fail('listing was not refreshed')
+
+    def test_listing_persisted(self):
+        fetch = mock.Mock(return_value=[{'name': 'repo'}])
+        self.assertEqual(([{'name': 'repo'}], False),
+                         RepoCache(self.path).get(self.key, fetch))
+        self.assertEqual(([{'name': 'repo'}], True),
+                         RepoCache(self.path).get(self.key, fetch))
+        self.assertEqual(1, fetch.call_count)
+
+    def test_listing_dumped(self):
+        repo = mock.Mock(archived=False)
+        repo.name = 'repo'
+
+        def dump(listed):
+            return {'name': listed.name}
+
+        self.assertEqual(([repo], False),
+                         RepoCache(self.path).get(self.key, lambda: [repo],
+                                                  dump))
+        self.assertEqual(([{'name': 'repo'}], True),
+                         RepoCache(self.path).get(self.key, None, dump))
+
+    def test_listing_persisted_in_new_directory(self):
+        path = join(self.tmp_dir, 'cache', 'repos.json')
+        RepoCache(path).get(self.key, lambda: [{'name': 'repo'}])
+        self.assertEqual(([{'name': 'repo'}], True),
+                         RepoCache(path).get(self.key, None))
+
+    def test_unwritable_cache_ignored(self):
+        path = join(self.tmp_dir, 'file', 'repos.json')
+        open(join(self.tmp_dir, 'file'), 'w').close()
+        cache = RepoCache(path)
+        self.assertEqual(([{'name': 'repo'}], False),
+                         cache.get(self.key, lambda: [{'name': 'repo'}]))
+        self.assertEqual(([{'name': 'repo'}], True),
+                         cache.get(self.key, None))
+
+    def test_stale_listing_refreshed_in_background(self):
+        RepoCache(self.path).get(self.key, lambda: [{'name': 'old'}])
+        cache = RepoCache(self.path, ttl=0)
+        self.assertEqual(([{'name': 'old'}], True),
+                         cache.get(self.key, lambda: [{'name': 'new'}]))
+        self.wait_refreshed(cache)
+        self.assertEqual(([{'name': 'new'}], True),
+                         RepoCache(self.path).get(self.key, None))
+
+    def test_expired_listing_refreshed_right_away(self):
+        RepoCache(self.path).get(self.key, lambda: [{'name': 'old'}])
+        cache = RepoCache(self.path, ttl=0, max_age=0)
+        self.assertEqual(([{'name': 'new'}], False),
+                         cache.get(self.key, lambda: [{'name': 'new'}]))
+        self.assertFalse(cache.refreshing)
+
+    def test_failed_refresh_keeps_listing(self):
+        cache = RepoCache(self.path, ttl=0)
+        cache.get(self.key, lambda: [{'name': 'old'}])
+        cache.get(self.key, mock.Mock(side_effect=ValueError))
+        self.wait_refreshed(cache)
+        self.assertEqual(([{'name': 'old'}], True),
+                         cache.get(self.key, None))
+
+    def test_forced_refresh_once(self):
+        RepoCache(self.path).get(self.key, lambda: [{'name': 'old'}])
+        cache = RepoCache(self.path, refresh=True)
+        fetch = mock.Mock(return_value=[{'name': 'new'}])
+        self.assertEqual(([{'name': 'new'}], False),
+                         cache.get(self.key, fetch))
+        self.assertEqual(([{'name': 'new'}], True),
+                         cache.get(self.key, fetch))
+        self.assertEqual(1, fetch.call_count)
+
+    def test_github_repos_cached(self):
+        repo = mock.Mock(archived=False, open_issues_count=0)
+        repo.name = 'repo'
+        uname = mock.Mock(**{'get_repos.return_value': [repo]})
+        repocache.configure(self.path)
+        repos = GithubService.list_repos(uname, 'org')
+        self.assertEqual(['repo'], [listed.name for listed in repos])
+        self.assertFalse(GithubService.select_repo(repos[0]))
+
+        # a pull request is opened, after the listing was cached
+        repo.open_issues_count = 1
+        repos = GithubService.list_repos(uname, 'org')
+        self.assertEqual(['repo'], [cached.name for cached in repos])
+        self.assertTrue(GithubService.select_repo(repos[0]))
+        self.assertEqual(1, uname.get_repos.call_count)
+
+        repos[0].archived = True
+        self.assertFalse(GithubService.select_repo(repos[0]))
+
+
+class RateLimitTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(ratelimit, 'RESET_SLACK', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_update_from_headers(self):
+        rate_limit = RateLimit()
+        rate_limit.update_from_headers({'X-RateLimit-Limit': '5000',
+                                        'X-RateLimit-Remaining': '4999',
+                                        'X-RateLimit-Reset': '1500000000'})
+        self.assertEqual((5000, 4999, 1500000000),
+                         (rate_limit.limit, rate_limit.remaining,
+                          rate_limit.reset))
+        rate_limit.update_from_headers({'RateLimit-Limit': '600',
+                                        'RateLimit-Remaining': '10',
+                                        'RateLimit-Reset': '60'})
+        self.assertEqual((600, 10), (rate_limit.limit, rate_limit.remaining))
+        self.assertTrue(rate_limit.reset > time.time() + 50)
+
+    def test_retry_delay(self):
+        now = 1500000000
+        self.assertEqual(None, retry_delay(200, {}, now))
+        self.assertEqual(None, retry_delay(403, {}, now))
+        self.assertEqual(30, retry_delay(429, {'Retry-After': '30'}, now))
+        self.assertEqual(10, retry_delay(
+            429, {'Retry-After': 'Fri, 14 Jul 2017 02:40:10 GMT'}, now))
+        self.assertEqual(100, retry_delay(
+            403, {'x-ratelimit-remaining': '0',
+                  'x-ratelimit-reset': str(now + 100)}, now))
+        self.assertEqual(ratelimit.DEFAULT_RETRY_DELAY,
+                         retry_delay(429, {}, now))
+
+    def test_waits_until_reset(self):
+        rate_limit = RateLimit()
+        rate_limit.update(100, 0, time.time() + 0.1)
+        start = time.time()
+        rate_limit.acquire()
+        rate_limit.release()
+        self.assertTrue(time.time() - start >= 0.1)
+
+    def test_one_at_a_time_when_low(self):
+        rate_limit = RateLimit()
+        rate_limit.update(100, 5, time.time() + 0.05)
+        rate_limit.acquire()
+        thread = threading.Thread(target=rate_limit.acquire)
+        thread.start()
+        thread.join(0.02)
+        self.assertTrue(thread.is_alive())
+        rate_limit.release()
+        thread.join()
+        self.assertEqual(1, rate_limit.active)
+
+    def test_adapter_retries_throttled_request(self):
+        request = PreparedRequest()
+        request.prepare(method='GET', url='https://throttled.example.com/',
+                        headers={'Authorization': 'token adapter'})
+        responses = [http_response(429, {'Retry-After': '0'}),
+                     http_response(200, {})]
+        with mock.patch.object(HTTPAdapter, 'send',
+                               side_effect=responses) as send:
+            res = RateLimitAdapter().send(request)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(2, send.call_count)
+
+    def test_github_throttled_request_retried(self):
+        session = Session()
+        session.mount('https://', RateLimitAdapter())
+        body = json.dumps({'name': 'repo'}).encode('utf-8')
+        responses = [http_response(429, {'Retry-After': '0'}),
+                     http_response(200, {}, body)]
+        g = GithubService().get_client('throttled')
+        with mock.patch('reviewrot.githubstack.get_session',
+                        return_value=session), \
+                mock.patch.object(HTTPAdapter, 'send',
+                                  side_effect=responses) as send:
+            self.assertEqual('repo', g.get_repo('owner/repo').name)
+        self.assertEqual(2, send.call_count)
+
 
 class CommandLineParserTest(TestCase):
     """
@@ -214,6 +1156,10 @@ class CommandLineParserTest(TestCase):
 
         cls.choices = {'duration': duration_choices, 'state': state_choices, 'format': format_choices}
 
+    def setUp(self):
+        # the config files are parsed again, as if by a new process
+        reviewrot._configs.clear()
+
     def test_args_from_config(self):
         cli_args = argparse.Namespace(cacert=None, debug=False, format=None,
                                       insecure=False, reverse=False,
@@ -234,6 +1180,15 @@ class CommandLineParserTest(TestCase):
         self.assertTrue(debug_result and reverse_result and format_result and
                         ssl_result and group_arguments)
 
+    def test_invalid_jobs_from_config(self):
+        self.assertEqual({'jobs': 4}, reviewrot.validate_config_arguments(
+            {'jobs': 4}, self.choices))
+        for jobs in (0, -2, '4', True):
+            with self.assertRaises(ValueError) as context:
+                reviewrot.validate_config_arguments({'jobs': jobs},
+                                                    self.choices)
+            self.assertTrue('positive integer' in str(context.exception))
+
     def test_args_from_command_line(self):
         cli_args = argparse.Namespace(cacert=None, debug=True, format='json',
                                       insecure=True, reverse=True,
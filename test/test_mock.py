@@ -33,7 +33,7 @@ def mock_get_repos():
 
 
 def mock_github_get_reviews(uname, repo_name, state_=None,
-                            value=None, duration=None):
+                            value=None, duration=None, since=None):
     msg = [github_config['msg']]
     return msg
 
@@ -48,7 +48,7 @@ def mock_get_repo_(repo_name):
     return repo
 
 
-def mock_get_pulls():
+def mock_get_pulls(**kwargs):
     return []
 
 # gitlab
@@ -71,6 +71,6 @@ def mock_groups_search(user_name):
 
 
 def mock_gitlab_get_reviews(uname, project, state_=None,
-                            value=None, duration=None):
+                            value=None, duration=None, since=None):
     msg = [gitlab_config['msg']]
     return msg
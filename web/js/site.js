@@ -7,31 +7,46 @@ var average_age = function(requests) {
 		cls: 'default'
 	}
 }
+// The report is read from data.json next to index.html, as written by
+// review-rot, unless another location is given with ?data=<url>, e.g.
+// ?data=http://127.0.0.1:8080/data.json for `review-rot serve`. Without
+// data.json, the sample data is shown.
+var default_data_url = 'data.json';
+var sample_data_url = 'js/default-data.json';
+var data_url = function() {
+	var match = /[?&]data=([^&]*)/.exec(window.location.search);
+	return match ? decodeURIComponent(match[1]) : default_data_url;
+}
 $(document).ready(function() {
 	var entry_template = Handlebars.compile($("#entry-template").html());
 	var stats_template = Handlebars.compile($("#stats-template").html());
 	var footer_template = Handlebars.compile($("#footer-template").html());
 
-	var xhr = $.ajax({
-		dataType: 'json',
-		cache: false,
-
-		// A user needs to change this value to get their site to work.
-		url: 'https://raw.githubusercontent.com/nirzari/review-rot/396e5a7e878e5ac9779973c7a42ca5de311a6ed5/web/js/default-data.json',
+	var load = function(url) {
+		// no cache busting parameter, so that the browser revalidates
+		// the report with If-None-Match and gets a 304 when unchanged
+		var xhr = $.ajax({
+			dataType: 'json',
+			url: url,
 
-		error: function() {
-			$('error-message').removeClass('hidden');
-		},
-		success: function(data) {
-			var modified = xhr.getResponseHeader("Last-Modified")
-			$('.footer').append(footer_template({
-				generated: moment(modified).fromNow()
-			}));
-			$.each(data, function(key, value) {
-				$('#reviews').append(entry_template(value));
-			});
-			$('.page-header').append(stats_template(average_age(data)));
-		}
-	})
+			error: function() {
+				if (xhr.status == 404 && url == default_data_url) {
+					load(sample_data_url);
+					return;
+				}
+				$('error-message').removeClass('hidden');
+			},
+			success: function(data) {
+				var modified = xhr.getResponseHeader("Last-Modified")
+				$('.footer').append(footer_template({
+					generated: moment(modified).fromNow()
+				}));
+				$.each(data, function(key, value) {
+					$('#reviews').append(entry_template(value));
+				});
+				$('.page-header').append(stats_template(average_age(data)));
+			}
+		})
+	}
+	load(data_url());
 });
-